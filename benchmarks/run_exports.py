@@ -0,0 +1,418 @@
+"""Benchmarks for mortimer's data exports.
+
+Times the export routes of the *web_experiments* blueprint and the
+helpers in :mod:`mortimer.export` on synthetic alfred3 session
+documents and reports throughput and peak memory.
+
+By default, the benchmarks run against an in-memory mongomock database.
+For realistic numbers, and for large datasets, use a local mongod::
+
+    python benchmarks/run_exports.py --sessions 1000 10000
+    python benchmarks/run_exports.py --mongo mongodb://localhost:27017 --sessions 100000
+
+With a local mongod, datasets are written to uniquely named collections
+in the *alfred* database and to a *mortimer_benchmark* database. Both
+are removed afterwards.
+
+Peak memory is measured with :mod:`tracemalloc`. It covers memory
+allocated by Python in the benchmark process, but not in the worker
+processes used for decryption. Tracing slows down execution, use
+``--no-memory`` for more accurate timings.
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import secrets
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+import synthetic
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import mortimer.export as export  # noqa: E402
+import mortimer.utils as mutils  # noqa: E402
+from mortimer import create_app  # noqa: E402
+
+USERNAME = "benchmark"
+TITLE = "benchmark"
+
+
+class Measurement:
+    def __init__(self, name: str, n_sessions: int, seconds: float, nbytes: int, peak):
+        self.name = name
+        self.n_sessions = n_sessions
+        self.seconds = seconds
+        self.nbytes = nbytes
+        self.peak = peak
+
+    @property
+    def sessions_per_second(self) -> float:
+        return self.n_sessions / self.seconds if self.seconds else float("inf")
+
+    @property
+    def megabytes_per_second(self) -> float:
+        return self.nbytes / 1e6 / self.seconds if self.seconds else float("inf")
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "sessions": self.n_sessions,
+            "seconds": self.seconds,
+            "output_bytes": self.nbytes,
+            "sessions_per_second": self.sessions_per_second,
+            "megabytes_per_second": self.megabytes_per_second,
+            "peak_memory_bytes": self.peak,
+        }
+
+    def __str__(self):
+        peak = "n/a" if self.peak is None else f"{self.peak / 1e6:10.1f}"
+        return (
+            f"{self.name:<28} {self.n_sessions:>8} {self.seconds:>9.2f} "
+            f"{self.sessions_per_second:>11.0f} {self.megabytes_per_second:>8.1f} {peak:>10}"
+        )
+
+
+HEADER = (
+    f"{'benchmark':<28} {'sessions':>8} {'seconds':>9} "
+    f"{'sessions/s':>11} {'MB/s':>8} {'peak MB':>10}"
+)
+
+
+def measure(name: str, n_sessions: int, fn, memory=True) -> Measurement:
+    """Runs *fn*, which returns the number of bytes it produced, and
+    measures its runtime and peak memory.
+    """
+    gc.collect()
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    nbytes = fn()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return Measurement(name, n_sessions, seconds, nbytes, peak)
+
+
+def count_bytes(chunks) -> int:
+    return sum(len(chunk) for chunk in export.encode_chunks(chunks))
+
+
+def optional(module: str) -> bool:
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+class Environment:
+    """Sets up a mortimer app with a benchmark user, an experiment and
+    synthetic data.
+    """
+
+    def __init__(self, mongo: str = None):
+        self.mongo = mongo
+        self.suffix = secrets.token_hex(4)
+        self.instance_path = tempfile.mkdtemp()
+
+        if mongo is None:
+            import mongomock
+
+            self.client = mongomock.MongoClient()
+            client_settings = "'mongo_client_class': mongomock.MongoClient"
+            mutils.get_alfred_db = self.alfred_db
+        else:
+            import pymongo
+
+            self.client = pymongo.MongoClient(mongo)
+            client_settings = f"'host': {mongo!r}"
+
+        config = [
+            f"SECRET_KEY = {Fernet.generate_key().decode()!r}",
+            "import mongomock" if mongo is None else "",
+            f"MONGODB_SETTINGS = {{'db': 'mortimer_benchmark', {client_settings}}}",
+            "TESTING = True",
+        ]
+        Path(self.instance_path, "mortimer.conf").write_text("\n".join(config))
+        logfile = os.path.join(self.instance_path, "mortimer.log")
+        self.app = create_app(instance_path=self.instance_path, logfile=logfile)
+
+        import mortimer.web_experiments.routes as routes
+
+        routes.get_alfred_db = mutils.get_alfred_db
+
+        self.key = Fernet.generate_key()
+        self.fernet = Fernet(self.key)
+        self.col = f"benchmark_{self.suffix}"
+        self.col_unlinked = f"benchmark_{self.suffix}_unlinked"
+        self.col_misc = f"benchmark_{self.suffix}_misc"
+
+    def alfred_db(self):
+        return self.client["alfred"]
+
+    def setup(self, n_sessions: int, seed: int, **fields):
+        from mortimer.models import User, WebExperiment
+
+        self.teardown()
+
+        with self.app.app_context():
+            f = mutils.create_fernet()
+            user = User(
+                username=USERNAME,
+                email="benchmark@example.com",
+                password="benchmark",
+                encryption_key=f.encrypt(self.key),
+                alfred_col=self.col,
+                alfred_col_unlinked=self.col_unlinked,
+                alfred_col_misc=self.col_misc,
+            ).save()
+            exp = WebExperiment(
+                title=TITLE,
+                author=USERNAME,
+                author_id=user.id,
+                version="2.0",
+                available_versions=["1.0", "1.1", "2.0"],
+                path=self.instance_path,
+            ).save()
+
+        self.user_id = str(user.id)
+        self.exp_id = str(exp.id)
+        self.metadata = synthetic.experiment_metadata(self.exp_id, TITLE, USERNAME)
+
+        db = self.alfred_db()
+        synthetic.populate(
+            random.Random(seed),
+            self.metadata,
+            self.fernet,
+            db[self.col],
+            db[self.col_unlinked],
+            db[self.col_misc],
+            n_sessions,
+            **fields,
+        )
+
+    def reset_caches(self):
+        """Removes persisted codebooks and fieldname catalogs, so that
+        routes have to do full scans.
+        """
+        from mortimer.models import Codebook, FieldnameCatalog
+
+        with self.app.app_context():
+            Codebook.objects(exp_id=self.exp_id).delete()
+            FieldnameCatalog.objects(exp_id=self.exp_id).delete()
+
+    def client_for_user(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = self.user_id
+            session["_fresh"] = True
+            session["plugin_data_query"] = {
+                "title": "Groups",
+                "type": "groups",
+                "query": {"filter": {"exp_id": self.exp_id, "type": "match_group"}},
+                "encrypted": False,
+            }
+        return client
+
+    def teardown(self):
+        db = self.alfred_db()
+        for col in [self.col, self.col_unlinked, self.col_misc]:
+            db.drop_collection(col)
+        self.client.drop_database("mortimer_benchmark")
+
+
+def route_benchmarks() -> dict:
+    """Returns route benchmarks as a dictionary of names and URLs."""
+    base = f"/{USERNAME}/{TITLE}"
+    routes = {
+        "route main csv": f"{base}/export_main_data/comma/all",
+        "route main csv gzip": f"{base}/export_main_data/comma/all?compression=gzip",
+        "route main csv columns": f"{base}/export_main_data/comma/all?columns=exp_session_id&columns=el000",
+        "route moves csv": f"{base}/export_move_data/comma/all",
+        "route unlinked csv": f"{base}/export_unlinked_data/comma/all",
+        "route unlinked json": f"{base}/export_unlinked_data/json/all",
+        "route full json": f"{base}/export_full_data/all",
+        "route full ndjson": f"{base}/export_full_data/ndjson/all",
+        "route codebook csv": f"{base}/export_codebook_data/comma/2.0",
+        "route plugin json": f"{base}/export_plugin_data/all",
+        "route bundle": f"{base}/export_bundle/comma/all",
+    }
+    if optional("pyarrow"):
+        routes["route main parquet"] = f"{base}/export_main_data/parquet/all"
+        routes["route unlinked parquet"] = f"{base}/export_unlinked_data/parquet/all"
+    if optional("openpyxl"):
+        routes["route main xlsx"] = f"{base}/export_main_data/xlsx/all"
+    return routes
+
+
+def run_route(client, url: str) -> int:
+    response = client.get(url, buffered=False)
+    try:
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} returned status {response.status_code}.")
+        return sum(len(chunk) for chunk in response.iter_encoded())
+    finally:
+        response.close()
+
+
+def helper_benchmarks(env: Environment, n_legacy: int) -> dict:
+    """Returns helper benchmarks as a dictionary of names and callables."""
+    from alfred3.data_manager import DataManager
+
+    db = env.alfred_db()
+    f = {"exp_id": env.exp_id}
+
+    with env.app.app_context():
+        from mortimer.models import FieldnameCatalog
+
+        fieldnames = FieldnameCatalog.fieldnames_for(
+            env.exp_id, ["all"], "exp_data", db[env.col]
+        )
+
+    def flat():
+        for doc in db[env.col].find(f):
+            yield DataManager.flatten(doc)
+
+    def unlinked():
+        for doc in db[env.col_unlinked].find(f):
+            yield DataManager.flatten(doc)
+
+    rng = random.Random(0)
+    legacy_path = Path(env.instance_path, "legacy.json")
+    with open(legacy_path, "w") as file:
+        for _ in range(n_legacy):
+            file.write(json.dumps(synthetic.legacy_document(rng)) + "\n")
+
+    def legacy():
+        with open(legacy_path) as file:
+            for line in file:
+                yield json.loads(line)
+
+    helpers = {
+        "csv_chunks": lambda: count_bytes(export.csv_chunks(flat(), fieldnames)),
+        "csv_chunks + gzip": lambda: count_bytes(
+            export.gzip_chunks(export.csv_chunks(flat(), fieldnames))
+        ),
+        "csv_chunks + zip": lambda: count_bytes(
+            export.zip_chunks([("data.csv", export.csv_chunks(flat(), fieldnames))])
+        ),
+        "json_chunks": lambda: count_bytes(export.json_chunks(db[env.col].find(f))),
+        "json_chunks ndjson": lambda: count_bytes(
+            export.json_chunks(db[env.col].find(f), ndjson=True)
+        ),
+        "shuffled": lambda: sum(1 for _ in export.shuffled(unlinked(), 1000)),
+        "decrypt_parallel": lambda: sum(
+            1 for _ in export.decrypt_parallel(unlinked(), env.key)
+        ),
+        "iter_json": lambda: count_bytes(export.iter_json(db[env.col].find(f))),
+        "iter_csv (legacy)": lambda: count_bytes(export.iter_csv(legacy())),
+        "to_csv (legacy)": lambda: len(export.to_csv(legacy()).getvalue()),
+        "cursor_to_rows (legacy)": lambda: len(export.cursor_to_rows(legacy())),
+    }
+
+    if optional("pyarrow"):
+
+        def parquet():
+            f = export.to_arrow(flat(), fieldnames)
+            return f.seek(0, os.SEEK_END)
+
+        helpers["to_arrow parquet"] = parquet
+
+    if optional("openpyxl"):
+
+        def xlsx():
+            f = export.to_xlsx(flat(), fieldnames)
+            return f.seek(0, os.SEEK_END)
+
+        helpers["to_xlsx"] = xlsx
+
+    return helpers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+        help="Numbers of sessions to benchmark, e.g. 1000 10000 100000.",
+    )
+    parser.add_argument(
+        "--mongo", help="MongoDB URI of a local mongod. Default: mongomock."
+    )
+    parser.add_argument(
+        "--elements", type=int, default=50, help="Elements per session."
+    )
+    parser.add_argument("--pages", type=int, default=10, help="Pages per session.")
+    parser.add_argument(
+        "--additional", type=int, default=10, help="Additional data fields per session."
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        help="Run only benchmarks whose names contain one of these.",
+    )
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="Keep persisted codebooks and fieldname catalogs between route runs.",
+    )
+    parser.add_argument(
+        "--no-memory", action="store_true", help="Do not measure peak memory."
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="Write results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    env = Environment(args.mongo)
+    results = []
+    try:
+        for n in args.sessions:
+            print(f"\nGenerating {n} sessions ...", flush=True)
+            env.setup(
+                n,
+                seed=args.seed,
+                n_elements=args.elements,
+                n_pages=args.pages,
+                n_additional=args.additional,
+            )
+            print(HEADER)
+
+            client = env.client_for_user()
+            benchmarks = {
+                name: (lambda url=url: run_route(client, url))
+                for name, url in route_benchmarks().items()
+            }
+            benchmarks.update(helper_benchmarks(env, n_legacy=n))
+
+            for name, fn in benchmarks.items():
+                if args.only and not any(s in name for s in args.only):
+                    continue
+                if name.startswith("route") and not args.warm:
+                    env.reset_caches()
+                with env.app.app_context():
+                    result = measure(name, n, fn, memory=not args.no_memory)
+                results.append(result)
+                print(result, flush=True)
+    finally:
+        env.teardown()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([r.as_dict() for r in results], f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""Synthetic alfred3 session documents for export benchmarks.
+
+The documents mimic the structure of the datasets that alfred3 saves to
+MongoDB: Main experiment datasets with element data, additional data,
+move histories and plugin queries, unlinked datasets with encrypted
+values, and plugin data. Additionally, nested documents with
+*subtree_data* can be generated for the legacy helpers in
+:mod:`mortimer.export`.
+
+All generators take a :class:`random.Random` instance, so that datasets
+are reproducible.
+"""
+
+import string
+import time
+import uuid
+
+ELEMENT_TYPES = [
+    "TextEntry",
+    "TextArea",
+    "NumberEntry",
+    "SingleChoice",
+    "MultipleChoice",
+    "SelectPageList",
+]
+CONDITIONS = ["control", "treatment_a", "treatment_b"]
+
+
+def random_text(rng, min_length=5, max_length=40) -> str:
+    length = rng.randint(min_length, max_length)
+    alphabet = string.ascii_letters + string.digits + "  \n,."
+    return "".join(rng.choices(alphabet, k=length))
+
+
+def element_value(rng, element_type: str, n_choices=4):
+    if element_type in ["TextEntry", "TextArea"]:
+        return random_text(rng) if rng.random() > 0.1 else None
+    elif element_type == "NumberEntry":
+        return rng.choice([rng.randint(0, 100), round(rng.uniform(0, 100), 2), None])
+    elif element_type in ["SingleChoice", "SelectPageList"]:
+        return rng.randint(1, n_choices)
+    elif element_type == "MultipleChoice":
+        return {f"choice{i}": rng.random() > 0.5 for i in range(1, n_choices + 1)}
+
+
+def element_data(rng, name: str, element_type: str, page: str) -> dict:
+    """Returns the data of one input element, as saved by alfred3."""
+    return {
+        "name": name,
+        "value": element_value(rng, element_type),
+        "element_type": element_type,
+        "label_top": f"Question {name}",
+        "label_left": None,
+        "label_right": None,
+        "label_bottom": None,
+        "placeholder": "",
+        "force_input": rng.random() > 0.5,
+        "parent": page,
+        "tree": f"_root._content.{page}.{name}",
+    }
+
+
+def additional_data(rng, n_fields: int, depth=2) -> dict:
+    """Returns nested additional data with about *n_fields* leaves."""
+    data = {}
+    for i in range(n_fields):
+        if depth > 0 and i % 4 == 3:
+            data[f"group{i}"] = additional_data(rng, 3, depth - 1)
+        else:
+            data[f"field{i}"] = rng.choice([rng.randint(0, 1000), random_text(rng)])
+    return data
+
+
+def move_history(rng, session_id: str, pages: list, start_time: float) -> list:
+    moves = []
+    t = start_time
+    for i, page in enumerate(pages, start=1):
+        duration = rng.uniform(1, 120)
+        moves.append(
+            {
+                "exp_session_id": session_id,
+                "move_number": i,
+                "tag": page,
+                "section_tag": "main",
+                "page_status": "closed",
+                "action": "forward",
+                "previous_page": pages[i - 2] if i > 1 else None,
+                "target_page": page,
+                "show_time": t,
+                "hide_time": t + duration,
+                "duration": duration,
+            }
+        )
+        t += duration
+    return moves
+
+
+def session_document(
+    rng, exp: dict, n_elements=50, n_pages=10, n_additional=10, finished_share=0.8
+) -> dict:
+    """Returns a main experiment dataset of one session.
+
+    Args:
+        rng: A :class:`random.Random` instance.
+        exp: Experiment metadata, see :func:`experiment_metadata`.
+        n_elements: Number of input elements.
+        n_pages: Number of pages the elements are spread over. Every
+            page is one move in the move history.
+        n_additional: Approximate number of additional data fields.
+        finished_share: Share of finished sessions.
+    """
+    session_id = uuid.UUID(int=rng.getrandbits(128)).hex
+    start_time = exp["start_time"] + rng.uniform(0, 90 * 24 * 60 * 60)
+    pages = [f"page{i:02d}" for i in range(1, n_pages + 1)]
+    finished = rng.random() < finished_share
+    if not finished:
+        pages = pages[: rng.randint(1, n_pages)]
+
+    exp_data = {}
+    for i in range(n_elements):
+        name = f"el{i:03d}"
+        element_type = ELEMENT_TYPES[i % len(ELEMENT_TYPES)]
+        page = pages[i * len(pages) // n_elements]
+        exp_data[name] = element_data(rng, name, element_type, page)
+
+    moves = move_history(rng, session_id, pages, start_time)
+
+    return {
+        "type": "exp_data",
+        "exp_author": exp["exp_author"],
+        "exp_title": exp["exp_title"],
+        "exp_id": exp["exp_id"],
+        "exp_version": rng.choice(exp["versions"]),
+        "alfred_version": "3.0.2",
+        "exp_start_time": start_time,
+        "exp_save_time": moves[-1]["hide_time"],
+        "exp_finished": finished,
+        "exp_aborted": False,
+        "exp_condition": rng.choice(CONDITIONS),
+        "exp_session_id": session_id,
+        "exp_session_timeout": 86400,
+        "exp_plugin_queries": [
+            {
+                "title": "Groups",
+                "type": "groups",
+                "query": {"filter": {"exp_id": exp["exp_id"], "type": "match_group"}},
+                "encrypted": False,
+            }
+        ],
+        "client_info": {
+            "ua_browser": "Firefox",
+            "ua_os": "Linux",
+            "screen_width": rng.choice([1280, 1920, 2560]),
+        },
+        "additional_data": additional_data(rng, n_additional),
+        "exp_move_history": moves,
+        "exp_data": exp_data,
+    }
+
+
+def unlinked_document(rng, exp: dict, fernet, n_elements=10) -> dict:
+    """Returns an unlinked dataset with values encrypted by *fernet*,
+    like alfred3 saves them.
+    """
+    exp_data = {}
+    for i in range(n_elements):
+        name = f"unlinked{i:02d}"
+        element = element_data(rng, name, "TextEntry", "unlinked_page")
+        element["value"] = fernet.encrypt(random_text(rng).encode()).decode()
+        exp_data[name] = element
+
+    return {
+        "type": "unlinked",
+        "exp_author": exp["exp_author"],
+        "exp_title": exp["exp_title"],
+        "exp_id": exp["exp_id"],
+        "exp_version": rng.choice(exp["versions"]),
+        "alfred_version": "3.0.2",
+        "exp_data": exp_data,
+    }
+
+
+def plugin_document(rng, exp: dict, i: int) -> dict:
+    """Returns plugin data, modeled after alfred3_interact group data."""
+    return {
+        "type": "match_group",
+        "exp_id": exp["exp_id"],
+        "exp_version": rng.choice(exp["versions"]),
+        "group_id": f"group{i}",
+        "members": [uuid.UUID(int=rng.getrandbits(128)).hex for _ in range(3)],
+        "roles": {"a": 0, "b": 1, "c": 2},
+        "data": additional_data(rng, 5),
+    }
+
+
+def legacy_document(rng, n_fields=20, n_children=3, depth=2, tag="root") -> dict:
+    """Returns a nested document with *subtree_data*, as processed by
+    :class:`mortimer.export.Header`.
+    """
+    doc = {"tag": tag, "uid": uuid.UUID(int=rng.getrandbits(128)).hex}
+    for i in range(n_fields):
+        # not every document has every field
+        if rng.random() < 0.9:
+            doc[f"field{i}"] = rng.choice([rng.randint(0, 1000), random_text(rng)])
+    if depth > 0:
+        doc["subtree_data"] = [
+            legacy_document(rng, n_fields // 2, n_children, depth - 1, f"{tag}_{i}")
+            for i in range(n_children)
+        ]
+    if tag == "root":
+        doc["additional_data"] = additional_data(rng, 5, depth=0)
+    return doc
+
+
+def experiment_metadata(exp_id: str, title="benchmark", author="benchmark") -> dict:
+    return {
+        "exp_id": exp_id,
+        "exp_title": title,
+        "exp_author": author,
+        "versions": ["1.0", "1.1", "2.0"],
+        "start_time": time.time() - 90 * 24 * 60 * 60,
+    }
+
+
+def populate(
+    rng,
+    exp: dict,
+    fernet,
+    col,
+    col_unlinked,
+    col_misc,
+    n_sessions: int,
+    batch_size=1000,
+    **fields,
+):
+    """Inserts *n_sessions* main datasets, as many unlinked datasets and
+    one plugin document per three sessions into the given collections.
+
+    Args:
+        **fields: Passed on to :func:`session_document`, e.g.
+            *n_elements*.
+    """
+    for start in range(0, n_sessions, batch_size):
+        n = min(batch_size, n_sessions - start)
+        col.insert_many([session_document(rng, exp, **fields) for _ in range(n)])
+        col_unlinked.insert_many(
+            [unlinked_document(rng, exp, fernet) for _ in range(n)]
+        )
+        col_misc.insert_many(
+            [plugin_document(rng, exp, start + i) for i in range(0, n, 3)]
+        )
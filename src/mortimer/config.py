@@ -87,6 +87,22 @@ class BaseConfig:
     # Alfred settings
     ALFRED_DB = "alfred"
 
+    # Export settings
+    EXPORT_DECRYPTION_PROCESSES = 2  # worker processes shared by all exports
+    EXPORT_DECRYPTION_CHUNK_SIZE = 200
+    EXPORT_PAGE_SIZE = 1000  # documents fetched per query in paginated exports
+    EXPORT_SHUFFLE_BUFFER_SIZE = 10000  # datasets held in memory for shuffling
+    # seconds until background exports are removed
+    EXPORT_JOB_MAX_AGE = 7 * 24 * 60 * 60
+    FIELDNAME_CATALOG_MAX_AGE = 24 * 60 * 60  # seconds until a full rescan
+    DATA_TABLE_MAX_LENGTH = 200  # maximum rows per page in the data preview
+    EXPERIMENTS_PER_PAGE = 50  # experiments per page in the experiment list
+    STATISTICS_MAX_AGE = 10 * 60  # seconds until listed statistics are recounted
+    STATISTICS_UPDATES_PER_PAGE = 5  # statistics recounted per experiment list page
+    PARTICIPATION_BATCH_SIZE = 100  # maximum alias-experiment pairs per batch check
+    USER_CACHE_TTL = 30  # seconds that logged in users are cached per process
+    USER_CACHE_SIZE = 512  # maximum number of cached users per process
+
     # Mail settings
     MAIL_USE = False
     MAIL_SERVER = None
@@ -1,9 +1,24 @@
+import collections
 import csv
+import heapq
 import io
-import random
+import itertools
+import json
+import math
+import multiprocessing
+import pickle
 import re
+import secrets
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime
 
-from bson import json_util
+from bson import Decimal128, ObjectId, json_util
 
 
 # this is necessary, because send_file requires bytes-like objects
@@ -21,6 +36,598 @@ def make_str_bytes(f):
     return bytes_f
 
 
+def encode_chunks(chunks):
+    """Encodes an iterable of str chunks to utf-8 bytes."""
+    for chunk in chunks:
+        yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+def _json_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    elif isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    elif isinstance(obj, Decimal128):
+        return str(obj.to_decimal())
+    elif isinstance(obj, bytes):
+        return obj.decode("utf-8", errors="replace")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def json_chunks(docs, ndjson=False, indent=4, sort_keys=True):
+    """Encodes documents to JSON one by one, yielding the output in
+    chunks.
+
+    ObjectIds are written as strings and datetimes as ISO 8601 strings.
+
+    Args:
+        docs: Iterable of documents, e.g. a MongoDB cursor.
+        ndjson: If *True*, the output is newline-delimited JSON with one
+            compact document per line. Otherwise, the output is a single
+            JSON array, formatted like :func:`json.dumps` formats a
+            list with the same *indent*.
+        indent: Indentation of the JSON array output.
+        sort_keys: If *True*, the keys of each document are sorted.
+
+    Yields:
+        str: Chunks of JSON output.
+    """
+    if ndjson:
+        for doc in docs:
+            yield json.dumps(doc, sort_keys=sort_keys, default=_json_default) + "\n"
+        return
+
+    prefix = " " * indent
+    first = True
+    for doc in docs:
+        encoded = json.dumps(
+            doc, indent=indent, sort_keys=sort_keys, default=_json_default
+        )
+        encoded = prefix + encoded.replace("\n", "\n" + prefix)
+        yield ("[\n" if first else ",\n") + encoded
+        first = False
+    yield "[]" if first else "\n]"
+
+
+def csv_chunks(rows, fieldnames, chunk_size=1000, **writerparams):
+    """Writes dictionaries to csv, yielding the output in chunks.
+
+    Args:
+        rows: Iterable of dictionaries. Keys that are not in
+            *fieldnames* are ignored.
+        fieldnames: The columns of the csv file, in order.
+        chunk_size: Number of rows per yielded chunk.
+        **writerparams: Passed on to :class:`csv.DictWriter`, e.g.
+            *delimiter*.
+
+    Yields:
+        str: Chunks of csv output, starting with the header row.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(
+        buffer, fieldnames=fieldnames, extrasaction="ignore", **writerparams
+    )
+    writer.writeheader()
+    for i, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if i % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def gzip_chunks(chunks, compresslevel=6):
+    """Compresses an iterable of str or bytes chunks on the fly and
+    yields the gzip file in chunks.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    for chunk in encode_chunks(chunks):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _ChunkSink:
+    """Unseekable, write-only file object that collects written bytes
+    until they are popped. Used as target for streamed zip archives.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_chunks(members, compresslevel=6):
+    """Builds a zip archive on the fly and yields it in chunks.
+
+    The archive is never held in memory as a whole: Members are
+    compressed as their content is produced, and the archive is written
+    to an unseekable stream, using data descriptors instead of
+    rewriting local file headers.
+
+    Args:
+        members: Iterable of (filename, chunks) tuples, where *chunks*
+            is an iterable of str or bytes chunks of the file's content.
+        compresslevel: Deflate compression level.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(
+        sink, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel
+    ) as archive:
+        for filename, chunks in members:
+            info = zipfile.ZipInfo(filename, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, "w", force_zip64=True) as member:
+                for chunk in encode_chunks(chunks):
+                    member.write(chunk)
+                    data = sink.pop()
+                    if data:
+                        yield data
+    yield sink.pop()
+
+
+def column_projection(columns) -> dict:
+    """Returns a MongoDB projection for alfred3 experiment datasets that
+    fetches only what is needed to build the given flat columns with
+    :meth:`alfred3.data_manager.DataManager.flatten`.
+
+    Element values are stored at ``exp_data.<name>.value``. Since
+    dictionary values of an element *name* are flattened to columns
+    ``<name>_<key>``, every part of a column name up to an underscore
+    is considered as a possible element name. Additional data is
+    fetched as a whole, if any additional data column is requested.
+    Paths below another projected path are dropped.
+
+    Args:
+        columns: Iterable of flat column names.
+    """
+    projection = {"_id": False}
+    for column in columns:
+        if "." in column or column.startswith("$"):
+            continue
+        if column.startswith("additional_data"):
+            projection["additional_data"] = True
+            continue
+
+        projection[column] = True
+        parts = column.split("_")
+        for i in range(1, len(parts) + 1):
+            name = "_".join(parts[:i])
+            if name:
+                projection[f"exp_data.{name}.value"] = True
+
+    # MongoDB rejects projections of a path and one of its subpaths
+    def below_other(path):
+        parts = path.split(".")
+        return any(".".join(parts[:i]) in projection for i in range(1, len(parts)))
+
+    return {path: value for path, value in projection.items() if not below_other(path)}
+
+
+def chunked(iterable, size):
+    """Yields lists of up to *size* consecutive items from *iterable*."""
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def _read_run(f):
+    f.seek(0)
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+
+def shuffled(items, buffer_size=10000):
+    """Yields the items of an iterable in random order, using bounded
+    memory.
+
+    Every item is assigned a random 64 bit sort key from a
+    cryptographically secure source. Items are collected in sorted runs
+    of up to *buffer_size* items. If there is more than one run, the
+    runs are spilled to temporary files and merged, so that at most one
+    run and one item per run are held in memory. Sorting by independent
+    random keys yields a uniformly random permutation.
+
+    Args:
+        items: Iterable of picklable items.
+        buffer_size: Maximum number of items held in memory.
+    """
+
+    def sortkey(entry):
+        return entry[0]
+
+    runs = []
+    buffer = []
+    try:
+        for item in items:
+            buffer.append((secrets.randbits(64), item))
+            if len(buffer) >= buffer_size:
+                buffer.sort(key=sortkey)
+                run = tempfile.TemporaryFile()
+                for entry in buffer:
+                    pickle.dump(entry, run, protocol=pickle.HIGHEST_PROTOCOL)
+                runs.append(run)
+                buffer = []
+
+        buffer.sort(key=sortkey)
+        merged = heapq.merge(*[_read_run(run) for run in runs], buffer, key=sortkey)
+        for _, item in merged:
+            yield item
+    finally:
+        for run in runs:
+            run.close()
+
+
+# Decryption pools are shared by all exports of a process, so that the
+# number of worker processes stays bounded. Workers are started with
+# forkserver (or spawn), because forking a multi-threaded web server
+# process can deadlock.
+_decryption_pools = {}
+_decryption_pools_lock = threading.Lock()
+
+
+def _decryption_pool(processes: int) -> ProcessPoolExecutor:
+    with _decryption_pools_lock:
+        pool = _decryption_pools.get(processes)
+        if pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            method = "forkserver" if "forkserver" in methods else "spawn"
+            pool = ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context(method)
+            )
+            _decryption_pools[processes] = pool
+        return pool
+
+
+def _discard_decryption_pool(processes: int, pool: ProcessPoolExecutor):
+    with _decryption_pools_lock:
+        if _decryption_pools.get(processes) is pool:
+            del _decryption_pools[processes]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _decrypt_chunk(chunk: list, key: bytes) -> list:
+    from alfred3.data_manager import decrypt_recursively
+
+    return decrypt_recursively(chunk, key=key)
+
+
+def decrypt_parallel(docs, key: bytes, processes: int = 2, chunk_size: int = 200):
+    """Decrypts documents in chunks on a shared pool of worker processes.
+
+    Only a bounded number of chunks is in flight at any time, and the
+    decrypted documents are yielded in their original order as soon as
+    their chunk is done. If all documents fit into a single chunk, they
+    are decrypted in the current process.
+
+    Args:
+        docs: Iterable of documents (or other values) to decrypt with
+            :func:`alfred3.data_manager.decrypt_recursively`.
+        key: The fernet key. It is sent to the workers with every chunk.
+        processes: Number of worker processes. There is one pool per
+            number of processes, shared by all calls.
+        chunk_size: Number of documents per chunk.
+
+    Yields:
+        The decrypted documents.
+    """
+    from alfred3.data_manager import decrypt_recursively
+
+    processes = processes or 1
+    chunks = chunked(docs, chunk_size)
+    first = next(chunks, [])
+    second = next(chunks, None)
+
+    if processes <= 1 or second is None:
+        for chunk in itertools.chain([first], [second] if second else [], chunks):
+            yield from decrypt_recursively(chunk, key=key)
+        return
+
+    pool = _decryption_pool(processes)
+    pending = collections.deque()
+    try:
+        for chunk in itertools.chain([first, second], chunks):
+            pending.append(pool.submit(_decrypt_chunk, chunk, key))
+            if len(pending) >= 2 * processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    except BrokenProcessPool:
+        _discard_decryption_pool(processes, pool)
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class ExportBundle:
+    """Exports main data, move history, unlinked data and codebooks of
+    an experiment as csv members of one zip archive, reading every
+    dataset only once.
+
+    Main datasets are fanned out while they are streamed into the main
+    data member: Their move histories are spooled to a temporary file.
+    The move history member is written from the spool once all main
+    datasets have been read, because its header depends on all moves.
+    Codebooks of main datasets are not merged from the exported
+    datasets, but passed in from the persisted codebooks, so that they
+    match the codebook export and its label change checks. The codebook
+    entries and, unless given, the columns of unlinked datasets are
+    collected while the unlinked datasets are read.
+
+    Args:
+        title: Experiment title, used in member filenames.
+        main_fieldnames: Columns of the main data member.
+        unlinked_fieldnames: Columns of the unlinked data member. If
+            None, they are collected from the unlinked datasets and the
+            header is written after all of them have been read.
+        codebooks: Mapping of experiment versions to codebook entries,
+            e.g. :attr:`mortimer.models.Codebook.entries`. One member
+            is written per version. Entries of unlinked datasets are
+            merged in.
+        unlinked_transform: Optional callable that receives an iterator
+            of flat unlinked datasets and returns the iterator that is
+            written, e.g. for shuffling and decryption. If
+            *unlinked_fieldnames* is None, it must consume all datasets
+            before it yields the first one, like :func:`.shuffled`.
+        **writerparams: Passed on to :func:`.csv_chunks`, e.g.
+            *delimiter*.
+    """
+
+    def __init__(
+        self,
+        title: str,
+        main_fieldnames: list,
+        unlinked_fieldnames: list = None,
+        codebooks: dict = None,
+        unlinked_transform=None,
+        **writerparams,
+    ):
+        self.title = title
+        self.main_fieldnames = main_fieldnames
+        self.unlinked_fieldnames = unlinked_fieldnames
+        self.codebooks = {v: dict(e) for v, e in (codebooks or {}).items()}
+        self.unlinked_transform = unlinked_transform
+        self.writerparams = writerparams
+
+        self.move_fieldnames = {}
+        self.unlinked_fieldnames_seen = {}
+
+    def _main_rows(self, docs, spool):
+        from alfred3.data_manager import DataManager
+
+        for dataset in docs:
+            for move in dataset.get("exp_move_history") or []:
+                self.move_fieldnames.update(dict.fromkeys(move))
+                pickle.dump(move, spool, protocol=pickle.HIGHEST_PROTOCOL)
+
+            dataset.setdefault("exp_data", {})
+            yield DataManager.flatten(dataset)
+
+    def _unlinked_rows(self, docs):
+        from alfred3.data_manager import DataManager
+
+        for dataset in docs:
+            self._merge_codebook(dataset)
+            row = DataManager.flatten(dataset)
+            self.unlinked_fieldnames_seen.update(dict.fromkeys(row))
+            yield row
+
+    def _merge_codebook(self, dataset):
+        from alfred3.data_manager import DataManager
+
+        # extract_codebook_data modifies the data it extracts from
+        meta = ["alfred_version", "exp_author", "exp_title", "exp_version"]
+        data = {key: dataset.get(key) for key in meta}
+        data["exp_data"] = {k: dict(v) for k, v in dataset.get("exp_data", {}).items()}
+        entries = DataManager.extract_codebook_data(data)
+        if entries:
+            self.codebooks.setdefault(dataset.get("exp_version"), {}).update(entries)
+
+    def _unlinked_chunks(self, docs):
+        rows = self._unlinked_rows(docs)
+        if self.unlinked_transform is not None:
+            rows = self.unlinked_transform(rows)
+
+        with tempfile.TemporaryFile() as spool:
+            if self.unlinked_fieldnames is None:
+                # the header depends on all unlinked datasets
+                if self.unlinked_transform is None:
+                    for row in rows:
+                        pickle.dump(row, spool, protocol=pickle.HIGHEST_PROTOCOL)
+                    rows = _read_run(spool)
+                else:
+                    first = next(rows, None)
+                    rows = itertools.chain([] if first is None else [first], rows)
+            fieldnames = self.unlinked_fieldnames
+            if fieldnames is None:
+                fieldnames = list(self.unlinked_fieldnames_seen)
+            yield from csv_chunks(rows, fieldnames, **self.writerparams)
+
+    def _codebook_rows(self, version):
+        from alfred3.data_manager import DataManager
+
+        data = self.codebooks[version]
+        fieldnames = DataManager.extract_fieldnames(data.values())
+        fieldnames = DataManager.sort_codebook_fieldnames(fieldnames)
+        return data.values(), fieldnames
+
+    def members(self, main_docs, unlinked_docs):
+        """Yields (filename, chunks) tuples for :func:`.zip_chunks`.
+
+        Members are produced lazily: Each member's content depends on
+        the datasets read for the previous members.
+
+        Args:
+            main_docs: Iterable of main experiment datasets.
+            unlinked_docs: Iterable of unlinked datasets.
+        """
+        with tempfile.TemporaryFile() as spool:
+            rows = self._main_rows(main_docs, spool)
+            fn = f"exp_data_{self.title}.csv"
+            yield fn, csv_chunks(rows, self.main_fieldnames, **self.writerparams)
+
+            moves = _read_run(spool)
+            fn = f"move_history_{self.title}.csv"
+            yield fn, csv_chunks(moves, list(self.move_fieldnames), **self.writerparams)
+
+        fn = f"unlinked_{self.title}.csv"
+        yield fn, self._unlinked_chunks(unlinked_docs)
+
+        for version in sorted(self.codebooks, key=str):
+            rows, fieldnames = self._codebook_rows(version)
+            fn = f"codebook_{self.title}_{version}.csv"
+            yield fn, csv_chunks(rows, fieldnames, **self.writerparams)
+
+    def chunks(self, main_docs, unlinked_docs, compresslevel=6):
+        """Yields the zip archive in chunks."""
+        members = self.members(main_docs, unlinked_docs)
+        return zip_chunks(members, compresslevel=compresslevel)
+
+
+def _encoded(chunks, encoding):
+    if encoding is None:
+        return chunks
+    return (chunk.encode(encoding) for chunk in chunks)
+
+
+def iter_json(docs, shuffle=False, decryptor=None, encoding="utf-8", buffer_size=10000):
+    """Turns an iterable of MongoDB documents into a JSON array and
+    yields it in chunks, one document per chunk.
+
+    The output is identical to :func:`bson.json_util.dumps` of a list
+    of the documents with an indentation of four spaces.
+
+    Args:
+        shuffle: If *True*, the document order will be shuffled
+            (useful e.g. for preventing a link of experiment and
+            unlinked data), see :func:`.shuffled`.
+        decryptor: An alfred3.data_manager.Decryptor instance, which,
+            if provided, will be used to try decryption of the values
+            of all documents.
+        encoding: Encoding of the yielded chunks. If *None*, str chunks
+            are yielded.
+        buffer_size: Maximum number of documents held in memory for
+            shuffling.
+    """
+    # shuffle first, so that decrypted documents are never spooled to disk
+    if shuffle:
+        docs = shuffled(docs, buffer_size=buffer_size)
+    if decryptor:
+        docs = (decryptor.decrypt(doc) for doc in docs)
+
+    def chunks():
+        sep = "[\n"
+        for doc in docs:
+            dumped = json_util.dumps(doc, indent=4)
+            yield sep + "    " + dumped.replace("\n", "\n    ")
+            sep = ",\n"
+        yield "[]" if sep == "[\n" else "\n]"
+
+    return _encoded(chunks(), encoding)
+
+
+def iter_rows(docs, none_value=None):
+    """Yields the flat header row and the data rows of nested documents,
+    see :class:`.Header`.
+
+    The header depends on all documents, so the documents are spooled
+    to a temporary file while the header is built and read back
+    afterwards. Memory use does not grow with the number of documents.
+    """
+    with tempfile.TemporaryFile() as spool:
+        h = None
+        for doc in docs:
+            if h is None:
+                h = Header(doc)
+            else:
+                h.addDoc(doc)
+            pickle.dump(doc, spool, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if h is None:
+            return
+
+        yield h.getFlatHeaders(False)
+        for doc in _read_run(spool):
+            row = h.getDataFromDoc(doc)
+            if none_value is not None:
+                row = [none_value if cell is None else cell for cell in row]
+            yield row
+
+
+def iter_csv(
+    docs,
+    none_value=None,
+    remove_linebreaks=False,
+    dialect="excel",
+    encoding="utf-8",
+    chunk_size=1000,
+    **writerparams,
+):
+    """Turns an iterable of nested documents into csv and yields the
+    output in chunks.
+
+    Args:
+        docs: Iterable of documents, see :class:`.Header`.
+        none_value: Replacement for missing values.
+        remove_linebreaks: If *True*, linebreaks are removed from all
+            string values.
+        dialect: csv dialect.
+        encoding: Encoding of the yielded chunks. If *None*, str chunks
+            are yielded.
+        chunk_size: Number of rows per yielded chunk.
+        **writerparams: Passed on to :func:`csv.writer`.
+    """
+
+    def chunks():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, dialect=dialect, **writerparams)
+        for i, row in enumerate(iter_rows(docs, none_value), start=1):
+            if remove_linebreaks and i > 1:
+                row = [
+                    cell.replace("\r", "").replace("\n", "")
+                    if isinstance(cell, str)
+                    else cell
+                    for cell in row
+                ]
+            writer.writerow(row)
+            if i % chunk_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return _encoded(chunks(), encoding)
+
+
+def iter_excel_csv(docs, none_value=None, encoding="utf-8", **writerparams):
+    return iter_csv(
+        docs,
+        none_value=none_value,
+        remove_linebreaks=True,
+        delimiter=";",
+        dialect="excel",
+        encoding=encoding,
+        **writerparams,
+    )
+
+
 def to_json(cursor, shuffle=False, decryptor=None):
     """Turns a MongoDB Cursor into a JSON file.
 
@@ -31,34 +638,29 @@ def to_json(cursor, shuffle=False, decryptor=None):
         decryptor: An alfred3.data_manager.Decryptor instance, which,
             if provided, will be used to try decryption of the values
             of all decouments.
-    """
-    data = list(cursor)
 
-    if decryptor:
-        decrypted_data = []
-        for doc in data:
-            decrypted_data.append(decryptor.decrypt(doc))
-        data = decrypted_data
-
-    if shuffle:
-        random.shuffle(data)
-    out = json_util.dumps(obj=data, indent=4)
-    return out
+    See :func:`.iter_json` for a streaming variant.
+    """
+    return "".join(iter_json(cursor, shuffle, decryptor, encoding=None))
 
 
 def to_csv(
     cursor, none_value=None, remove_linebreaks=False, dialect="excel", **writerparams
 ):
-    rows = cursor_to_rows(cursor, none_value)
-    if remove_linebreaks:
-        for i in range(1, len(rows)):
-            for j in range(len(rows[i])):
-                if isinstance(rows[i][j], str) or isinstance(rows[i][j], str):
-                    rows[i][j].replace("\n", "")
+    """Turns a MongoDB Cursor into a csv file. See :func:`.iter_csv`
+    for a streaming variant.
+    """
     csvfile = io.StringIO()
-    writer = csv.writer(csvfile, dialect=dialect, **writerparams)
-    for row in rows:
-        writer.writerow([cell for cell in row])
+    chunks = iter_csv(
+        cursor,
+        none_value=none_value,
+        remove_linebreaks=remove_linebreaks,
+        dialect=dialect,
+        encoding=None,
+        **writerparams,
+    )
+    for chunk in chunks:
+        csvfile.write(chunk)
     return csvfile
 
 
@@ -73,33 +675,270 @@ def to_excel_csv(cursor, none_value=None, **writerparams):
     )
 
 
-# def to_excel(cursor, none_value=None):
-#     from openpyxl import Workbook
-#     wb = Workbook(encoding='utf-8')
-#     sheet = wb.get_active_sheet()
-#     docs = cursor_to_rows(cursor, none_value)
-#     for i in range(len(docs)):
-#         for j in range(len(docs[i])):
-#             tmp = docs[i][j]
-#             if not(isinstance(tmp, str) and isinstance(tmp, str) and
-#                     isinstance(tmp, float) and isinstance(tmp, int)):
-#                 tmp = str(tmp)
-#             sheet.cell(row=i, column=j).value = tmp
-#     # f = TemporaryFile()
-#     f = io.StringIO()
-#     wb.save(f)
-#     f.seek(0)
-#     return f
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+XLSX_MAX_ROWS = 1048576  # rows per worksheet, including the header
+XLSX_MAX_CELL_LENGTH = 32767
 
 
-def natural_sort(inp):
-    def convert(text):
-        return int(text) if text.isdigit() else text.lower()
+def _xlsx_value(value, illegal_characters):
+    if value is None or isinstance(value, (bool, int)):
+        return value
+    elif isinstance(value, float):
+        return value if math.isfinite(value) else str(value)
+    elif isinstance(value, (datetime, date)):
+        # excel does not support timezones
+        if getattr(value, "tzinfo", None) is not None:
+            value = value.replace(tzinfo=None)
+        return value
+    elif not isinstance(value, str):
+        value = str(value)
+    return illegal_characters.sub("", value)[:XLSX_MAX_CELL_LENGTH]
+
+
+def to_xlsx(rows, fieldnames, sheet_title="data", max_rows=XLSX_MAX_ROWS):
+    """Writes flat datasets to an Excel workbook.
+
+    The workbook is built in openpyxl's write-only mode, which writes
+    rows to disk as they are added, so that worksheets are never held in
+    memory. Numbers, booleans and dates are written as typed cells, all
+    other values as strings, without the control characters that are
+    illegal in xlsx files. If there are more rows than fit on a
+    worksheet, additional worksheets are added, each with its own
+    header row.
+
+    Args:
+        rows: Iterable of flat datasets (dictionaries).
+        fieldnames: The columns to include, in order.
+        sheet_title: Title of the first worksheet. Additional worksheets
+            are numbered.
+        max_rows: Maximum number of rows per worksheet, including the
+            header row.
+
+    Returns:
+        A binary file object, positioned at the start of the file.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+    wb = Workbook(write_only=True)
+    sheet = None
+    n_sheets = 0
+    n_rows = max_rows
+    for row in rows:
+        if n_rows >= max_rows:
+            n_sheets += 1
+            title = sheet_title if n_sheets == 1 else f"{sheet_title} ({n_sheets})"
+            sheet = wb.create_sheet(title=title)
+            sheet.append(fieldnames)
+            n_rows = 1
+
+        sheet.append(
+            [_xlsx_value(row.get(name), ILLEGAL_CHARACTERS_RE) for name in fieldnames]
+        )
+        n_rows += 1
+
+    if sheet is None:
+        wb.create_sheet(title=sheet_title).append(fieldnames)
+
+    f = tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024)
+    wb.save(f)
+    f.seek(0)
+    return f
 
-    def alphanum_key(key):
-        return [convert(c) for c in re.split("([0-9]+)", key[0])]
 
-    return sorted(inp, key=alphanum_key)
+# columnar file formats and their mimetypes
+ARROW_FORMATS = {
+    "parquet": "application/vnd.apache.parquet",
+    "feather": "application/vnd.apache.arrow.file",
+}
+
+
+def _arrow_kind(value):
+    if isinstance(value, bool):
+        return "bool"
+    elif isinstance(value, int):
+        return "int"
+    elif isinstance(value, float):
+        return "float"
+    elif isinstance(value, str):
+        return "str"
+    elif isinstance(value, datetime):
+        return "datetime"
+    return "other"
+
+
+def _arrow_kinds(rows, fieldnames):
+    kinds = {name: set() for name in fieldnames}
+    for row in rows:
+        for name, value in row.items():
+            if value is not None and name in kinds:
+                kinds[name].add(_arrow_kind(value))
+    return kinds
+
+
+def _arrow_schema(kinds):
+    import pyarrow as pa
+
+    types = {
+        frozenset(["bool"]): pa.bool_(),
+        frozenset(["int"]): pa.int64(),
+        frozenset(["float"]): pa.float64(),
+        frozenset(["int", "float"]): pa.float64(),
+        frozenset(["datetime"]): pa.timestamp("us"),
+    }
+    fields = [
+        pa.field(name, types.get(frozenset(column), pa.string()))
+        for name, column in kinds.items()
+    ]
+    return pa.schema(fields)
+
+
+def arrow_schema(rows, fieldnames):
+    """Infers an arrow schema for flat datasets.
+
+    Every column gets the type of its non-missing values. Integer
+    columns that also contain floats become float columns. Columns
+    without values and columns with mixed or nested values are stored
+    as strings.
+
+    Args:
+        rows: Iterable of flat datasets (dictionaries), e.g. the output
+            of :meth:`alfred3.data_manager.DataManager.flatten`.
+        fieldnames: The columns to include, in order.
+    """
+    return _arrow_schema(_arrow_kinds(rows, fieldnames))
+
+
+def _arrow_batch(rows, schema):
+    import pyarrow as pa
+
+    columns = []
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+        if pa.types.is_string(field.type):
+            values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+        columns.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+class _ArrowFile:
+    """A parquet or feather file in a spooled temporary file, which can
+    be rewritten with a wider schema.
+    """
+
+    def __init__(self, schema, fmt):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.schema = schema
+        self.fmt = fmt
+        self.f = tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024)
+        if fmt == "parquet":
+            self.writer = pq.ParquetWriter(self.f, schema, compression="zstd")
+        elif fmt == "feather":
+            options = pa.ipc.IpcWriteOptions(compression="zstd")
+            self.writer = pa.ipc.new_file(self.f, schema, options=options)
+        else:
+            raise ValueError(f"Unknown columnar format '{fmt}'.")
+
+    def write(self, rows):
+        self.writer.write_batch(_arrow_batch(rows, self.schema))
+
+    def close(self):
+        self.writer.close()
+        self.f.seek(0)
+        return self.f
+
+    def batches(self):
+        """Closes the file and yields its record batches."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        f = self.close()
+        if self.fmt == "parquet":
+            yield from pq.ParquetFile(f).iter_batches()
+        else:
+            reader = pa.ipc.open_file(f)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i)
+
+    def rewrite(self, schema):
+        """Returns a copy of the file with the wider *schema*. Values
+        are converted like new ones, e.g. to strings.
+        """
+        wider = _ArrowFile(schema, self.fmt)
+        for batch in self.batches():
+            wider.write(batch.to_pylist())
+        self.f.close()
+        return wider
+
+
+def _collected_fieldnames(rows, fieldnames=()):
+    collected = dict.fromkeys(fieldnames)
+    for row in rows:
+        collected.update(dict.fromkeys(row))
+    collected.pop("_id", None)
+    return list(collected)
+
+
+def to_arrow(rows, fieldnames=None, fmt="parquet", batch_size=5000):
+    """Writes flat datasets to a columnar parquet or feather file.
+
+    The datasets are consumed only once and written in record batches of
+    *batch_size* rows, so only one batch is held in memory at a time.
+    The schema is inferred from the first batch like :func:`arrow_schema`.
+    If a later batch does not fit the schema, the conflicting columns
+    are widened, i.e. integer columns become float columns and all
+    others string columns, and the batches written so far are rewritten
+    with the wider schema. Columns without values in the first batch
+    are string columns.
+
+    Args:
+        rows: Iterable of flat datasets (dictionaries).
+        fieldnames: The columns to include, in order, e.g. from the
+            fieldname catalog. If None, all columns are included in the
+            order in which they first appear.
+        fmt: Either "parquet" or "feather".
+        batch_size: Number of rows per record batch.
+
+    Returns:
+        A binary file object, positioned at the start of the file.
+    """
+    batches = chunked(rows, batch_size)
+    first = next(batches, [])
+    collect = fieldnames is None
+    if collect:
+        fieldnames = _collected_fieldnames(first)
+
+    # columns without values are fixed to strings, like nested values
+    kinds = _arrow_kinds(first, fieldnames)
+    for column in kinds.values():
+        if not column:
+            column.add("other")
+    f = _ArrowFile(_arrow_schema(kinds), fmt)
+    f.write(first)
+
+    for batch in batches:
+        new = _collected_fieldnames(batch) if collect else fieldnames
+        for name, column in _arrow_kinds(batch, new).items():
+            kinds.setdefault(name, {"other"}).update(column)
+        schema = _arrow_schema(kinds)
+        if schema != f.schema:
+            f = f.rewrite(schema)
+        f.write(batch)
+
+    return f.close()
+
+
+def _natural_key(text: str) -> list:
+    return [int(c) if c.isdigit() else c.lower() for c in re.split("([0-9]+)", text)]
+
+
+def natural_sort(inp):
+    """Sorts (key, value) tuples naturally by their keys, i.e. "a2"
+    comes before "a10".
+    """
+    return sorted(inp, key=lambda item: _natural_key(item[0]))
 
 
 def cursor_to_rows(cursor, none_value=None):
@@ -107,53 +946,82 @@ def cursor_to_rows(cursor, none_value=None):
     h = Header(*docs)
     rows = [h.getFlatHeaders(False)] + h.getDataFromDocs(docs)
     if none_value is not None:
-        for i in range(1, len(rows)):
-            for j in range(len(rows[i])):
-                if rows[i][j] is None:
-                    rows[i][j] = none_value
+        for row in rows[1:]:
+            for j, cell in enumerate(row):
+                if cell is None:
+                    row[j] = none_value
     return rows
 
 
 class Header:
-    def __init__(self, *docs):
-        self.tag = docs[0]["tag"]
+    """Column headers of nested documents with a *tag*, optional
+    *subtree_data* (a list of child documents) and optional
+    *additional_data*.
+
+    Children and names are indexed in dictionaries, so that adding a
+    document takes time linear in its number of fields. Only names that
+    are new to the header are sorted naturally and appended. The header
+    is frozen when the first row is built: Its columns are computed once
+    and no more documents can be added.
+    """
+
+    IGNORED = {"_id", "tag", "uid", "subtree_data", "additional_data"}
+
+    def __init__(self, *docs, tag: str = None):
+        self.tag = docs[0]["tag"] if tag is None else tag
         self.parent = None
-        self.names = []
-        self.children = []
+        self.names = {}  # used as an ordered set
+        self.children = {}  # tag: Header
         self.additional_data = None
 
+        self._frozen = False
+        self._width = None
+
         for doc in docs:
-            self.addDoc(doc)
+            self.addDoc(doc, tag=tag)
 
     def setParent(self, p):
         self.parent = p
         return self
 
-    def addDoc(self, doc):
-        assert self.tag == doc["tag"]
-        for k, v in natural_sort(list(doc.items())):
-            if k in ["_id", "tag", "uid"]:
-                pass
-            elif k == "subtree_data":
-                for subDoc in v:
-                    if subDoc == {}:
-                        continue
-                    found = False
-                    for child in self.children:
-                        if subDoc["tag"] == child.tag:
-                            child.addDoc(subDoc)
-                            found = True
-                            break
-                    if not found:
-                        self.children.append(Header(subDoc).setParent(self))
-            elif k == "additional_data":
-                v["tag"] = "additional_data"
-                if self.additional_data is None:
-                    self.additional_data = Header(v)
-                else:
-                    self.additional_data.addDoc(v)
-            elif k not in self.names:
-                self.names.append(k)
+    def addDoc(self, doc, tag: str = None):
+        if self._frozen:
+            raise RuntimeError("Documents cannot be added to a frozen header.")
+        assert self.tag == (doc["tag"] if tag is None else tag)
+
+        new = [k for k in doc if k not in self.names and k not in self.IGNORED]
+        new.sort(key=_natural_key)
+        self.names.update(dict.fromkeys(new))
+
+        for subDoc in doc.get("subtree_data", []):
+            if subDoc == {}:
+                continue
+            child = self.children.get(subDoc["tag"])
+            if child is None:
+                self.children[subDoc["tag"]] = Header(subDoc).setParent(self)
+            else:
+                child.addDoc(subDoc)
+
+        if "additional_data" in doc:
+            adata = doc["additional_data"]
+            if self.additional_data is None:
+                self.additional_data = Header(adata, tag="additional_data")
+            else:
+                self.additional_data.addDoc(adata, tag="additional_data")
+
+    def freeze(self):
+        """Freezes the header and its children and computes the number
+        of columns.
+        """
+        if self._frozen:
+            return
+        for child in self.children.values():
+            child.freeze()
+        if self.additional_data:
+            self.additional_data.freeze()
+
+        self._frozen = True
+        self._width = len(self.getFlatHeaders(False))
 
     def getFlatHeaders(self, with_root=True, deep=True, additional_data=True):
         rl = []
@@ -161,7 +1029,7 @@ class Header:
         for name in self.names:
             rl.append(pre + name)
         if deep:
-            for child in self.children:
+            for child in self.children.values():
                 for h in child.getFlatHeaders():
                     rl.append(pre + h)
         if self.additional_data and additional_data:
@@ -169,39 +1037,47 @@ class Header:
                 rl.append(pre + h)
         return rl
 
-    def getDataFromDoc(self, doc):
-        rv = []
-        assert doc == {} or doc["tag"] == self.tag
-        headers = self.getFlatHeaders(False, False, False)
-        for header in headers:
-            rv.append(doc.get(header, None))
-        for child in self.children:
-            found = False
+    def _fill(self, doc, row: list, start: int) -> int:
+        """Writes the values of *doc* to *row*, beginning at index
+        *start*, and returns the index after the last column.
+        """
+        i = start
+        for name in self.names:
+            row[i] = doc.get(name)
+            i += 1
+
+        if self.children:
+            subdocs = {}
             for subDoc in doc.get("subtree_data", []):
-                try:
-                    if subDoc["tag"] == child.tag:
-                        found = True
-                        break
-                except KeyError:
-                    print(subDoc)
-                    raise Exception("break")
-            rv = rv + child.getDataFromDoc(subDoc if found else {})
+                if subDoc:
+                    subdocs.setdefault(subDoc["tag"], subDoc)
+            for tag, child in self.children.items():
+                subDoc = subdocs.get(tag)
+                if subDoc is None:
+                    i += child._width
+                else:
+                    i = child._fill(subDoc, row, i)
+
         if self.additional_data:
-            rv = rv + self.additional_data.getDataFromDoc(
-                doc.get("additional_data", {})
-            )
-        return rv
+            adata = doc.get("additional_data")
+            if adata is None:
+                i += self.additional_data._width
+            else:
+                i = self.additional_data._fill(adata, row, i)
+
+        return i
+
+    def getDataFromDoc(self, doc):
+        assert doc == {} or doc["tag"] == self.tag or self.tag == "additional_data"
+        self.freeze()
+        row = [None] * self._width
+        self._fill(doc, row, 0)
+        return row
 
     def getDataFromDocs(self, docs):
-        rv = []
-        for doc in docs:
-            rv.append(self.getDataFromDoc(doc))
-        return rv
+        return [self.getDataFromDoc(doc) for doc in docs]
 
-    def __unicode__(self):
+    def __str__(self):
         if self.parent:
             return str(self.parent) + "." + self.tag
         return str(self.tag)
-
-    def __str__(self):
-        return str(self).encode("utf-8")
@@ -100,9 +100,13 @@ class WebExperimentForm(FlaskForm):
     script = FileField("script.py", validators=[FileAllowed(["py"])])
 
     def validate_title(self, title):
-        experiment = WebExperiment.objects(
-            title__exact=title.data, author__exact=current_user.username
-        ).first()
+        experiment = (
+            WebExperiment.objects(
+                title__exact=title.data, author__exact=current_user.username
+            )
+            .only("id")
+            .first()
+        )
         if experiment is not None:
             raise ValidationError(
                 "You already have a web experiment with this title. Please choose a unique title."
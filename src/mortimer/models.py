@@ -1,26 +1,66 @@
+import copy
+import hashlib
+import itertools
 import logging
 import secrets
 import string
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
 
 from alfred3 import alfredlog
 from alfred3.config import ExperimentConfig, ExperimentSecrets
+from alfred3.data_manager import DataManager
 from cryptography.fernet import Fernet
 from flask import current_app
 from flask_login import UserMixin
 from itsdangerous.url_safe import URLSafeTimedSerializer as Serializer
+from pymongo.errors import DuplicateKeyError
 
 from mortimer import db, login_manager
-from mortimer.utils import create_fernet
-from mongoengine import get_connection
+from mortimer.export import chunked
+from mortimer.utils import (
+    StampedCache,
+    create_fernet,
+    load_script,
+    script_hash,
+    store_script,
+)
+from mongoengine import get_connection, queryset_manager
 
 # pylint: disable=no-member
 
 
+_user_cache = None
+
+
+def user_cache() -> StampedCache:
+    """Returns the cache of user documents of this process. It is
+    created on first use, with the size and time to live given by
+    *USER_CACHE_SIZE* and *USER_CACHE_TTL*.
+    """
+    global _user_cache
+    if _user_cache is None:
+        _user_cache = StampedCache(
+            maxsize=current_app.config["USER_CACHE_SIZE"],
+            ttl=current_app.config["USER_CACHE_TTL"],
+        )
+    return _user_cache
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.objects(id=user_id).first()
+    # Users are cached as raw documents, so that every request gets its
+    # own instance. The cache is cleared when a user is saved in this
+    # process; other processes see changes after the time to live.
+    cache = user_cache()
+    son = cache.get(user_id)
+    if son is not None:
+        return User._from_son(copy.deepcopy(son))
+
+    user = User.objects(id=user_id).first()
+    if user is not None:
+        cache.set(user_id, user.to_mongo())
+    return user
 
 
 class User(db.Document, UserMixin):
@@ -79,6 +119,52 @@ class User(db.Document, UserMixin):
         pw_enc = f.encrypt(pw_raw.encode())
         return pw_enc
 
+    # compound indexes for the queries that mortimer runs on the user's
+    # alfred collections, by name of the collection attribute
+    ALFRED_INDEXES = {
+        "alfred_col": [
+            [("exp_id", 1), ("type", 1), ("exp_version", 1), ("exp_save_time", 1)],
+            # sort orders of the data table, see SORTABLE_FIELDS
+            [("exp_id", 1), ("type", 1), ("exp_save_time", 1), ("_id", 1)],
+            [("exp_id", 1), ("type", 1), ("exp_start_time", 1), ("_id", 1)],
+            [("exp_id", 1), ("type", 1), ("exp_session_id", 1), ("_id", 1)],
+            [("exp_id", 1), ("type", 1), ("exp_finished", 1), ("exp_start_time", 1)],
+        ],
+        "alfred_col_unlinked": [
+            [("exp_id", 1), ("type", 1), ("exp_version", 1), ("_id", 1)],
+        ],
+        "alfred_col_misc": [
+            [("exp_id", 1), ("type", 1), ("exp_version", 1)],
+        ],
+    }
+
+    def missing_indexes(self) -> dict:
+        """Returns a dictionary of the names of the user's alfred
+        collections to lists of the keys of indexes from
+        :attr:`.ALFRED_INDEXES` that do not exist.
+        """
+        alfred_db = get_connection()[current_app.config["ALFRED_DB"]]
+        missing = {}
+        for attr, indexes in self.ALFRED_INDEXES.items():
+            colname = getattr(self, attr)
+            if not colname:
+                continue
+            info = alfred_db[colname].index_information()
+            existing = [list(index["key"]) for index in info.values()]
+            missing[colname] = [keys for keys in indexes if keys not in existing]
+        return missing
+
+    def create_indexes(self) -> list:
+        """Creates missing indexes on the user's alfred collections and
+        returns the names of the created indexes.
+        """
+        alfred_db = get_connection()[current_app.config["ALFRED_DB"]]
+        created = []
+        for colname, indexes in self.missing_indexes().items():
+            for keys in indexes:
+                created.append(alfred_db[colname].create_index(keys))
+        return created
+
     def _prepare_db_role_privileges(self):
         alfred_db = current_app.config["ALFRED_DB"]
         res = {"db": alfred_db}
@@ -148,6 +234,7 @@ class User(db.Document, UserMixin):
 
         self.create_db_role()
         self.create_db_user()
+        self.create_indexes()
 
     @property
     def mongo_saving_agent(self) -> dict:
@@ -212,6 +299,15 @@ class User(db.Document, UserMixin):
 
         return User.objects.get(id=user_id)
 
+    def save(self, *args, **kwargs):
+        user = super().save(*args, **kwargs)
+        user_cache().pop(str(self.id))
+        return user
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        user_cache().pop(str(self.id))
+
     def __repr__(self):
         return f"User({self.username}, {self.email})"
 
@@ -229,7 +325,10 @@ class WebExperiment(db.Document):
     title_from_script = db.StringField()  # Deprecated
     author_mail_from_script = db.StringField()  # Deprecated
 
-    script = db.StringField()
+    # scripts are kept in the script store, see mortimer.utils.store_script
+    legacy_script = db.StringField(db_field="script")  # script text of old documents
+    script_hash = db.StringField()
+    script_history = db.ListField(field=db.DictField())  # hash, saved
     script_name = db.StringField()
     script_fullpath = db.StringField()
     path = db.StringField()  # full path to exp directory
@@ -246,6 +345,83 @@ class WebExperiment(db.Document):
     active = db.BooleanField(default=False)
     urlparam = db.StringField()
 
+    # fields that are only needed to run or edit the experiment
+    LARGE_FIELDS = [
+        "legacy_script",
+        "script_history",
+        "exp_config",
+        "exp_secrets",
+        "settings",
+    ]
+
+    @queryset_manager
+    def light(doc_cls, queryset):  # pylint: disable=no-self-argument
+        """Like *objects*, but without :attr:`.LARGE_FIELDS`. Documents
+        loaded this way can be saved, since only changed fields are
+        written.
+        """
+        return queryset.exclude(*doc_cls.LARGE_FIELDS)
+
+    @property
+    def has_script(self) -> bool:
+        return bool(self.script_hash or self.legacy_script)
+
+    @property
+    def script(self) -> str:
+        """The experiment's script.py. Setting it stores the script in
+        the script store and adds it to :attr:`.script_history`.
+
+        For saved experiments, the new hash, the history entry and the
+        removal of :attr:`.legacy_script` are written immediately in one
+        atomic update, because the history and the legacy script are
+        missing from experiments that were loaded with :attr:`.light`.
+
+        If the script is missing from the store, it is restored from the
+        experiment's script file, if that has the same hash. Otherwise,
+        the script is *None*.
+        """
+        if self.script_hash:
+            try:
+                return load_script(self.script_hash)
+            except FileNotFoundError:
+                return self._restore_script()
+        return self.legacy_script
+
+    @script.setter
+    def script(self, script: str):
+        digest = store_script(script)
+        if digest == self.script_hash:
+            return
+
+        entry = {"hash": digest, "saved": datetime.now()}
+        if self.pk is None:
+            self.script_history.append(entry)
+        else:
+            self.update(
+                set__script_hash=digest,
+                push__script_history=entry,
+                unset__legacy_script=True,
+            )
+        self.script_hash = digest
+        self.legacy_script = None
+
+    def _restore_script(self):
+        molog = logging.getLogger("mortimer")
+        try:
+            script = Path(self.script_fullpath).read_text(encoding="utf-8")
+        except (OSError, TypeError):
+            script = None
+
+        if script is None or script_hash(script) != self.script_hash:
+            molog.error(
+                f"Script {self.script_hash} of experiment {self.id} is missing."
+            )
+            return None
+
+        store_script(script)
+        molog.warning(f"Restored script {self.script_hash} of experiment {self.id}.")
+        return script
+
     def prepare_logger(self):
         """Sets the formatter and file handler for the experiment
         logger.
@@ -340,5 +516,637 @@ class WebExperiment(db.Document):
 
 
 class Participant(db.Document):
+    """Participation of a person in experiments, identified by a hashed
+    alias. Participation is stored as ``experiments.<exp_id>.versions``.
+
+    Registrations and checks are single atomic operations on the
+    uniquely indexed alias, so that concurrent requests cannot
+    overwrite each other.
+    """
+
     alias = db.StringField(required=True, unique=True)
     experiments = db.DictField()
+
+    @staticmethod
+    def hash_alias(alias: str) -> str:
+        return hashlib.sha224(alias.encode()).hexdigest()
+
+    @staticmethod
+    def _experiment_field(exp_id: str) -> str:
+        if not exp_id or "." in exp_id or exp_id.startswith("$"):
+            raise ValueError(f"Invalid experiment ID: {exp_id}")
+        return f"experiments.{exp_id}"
+
+    @classmethod
+    def register(cls, alias: str, exp_id: str, exp_version: str) -> bool:
+        """Registers the participation of the (hashed) *alias* in an
+        experiment version.
+
+        Returns:
+            bool: *True*, if the participation was new.
+        """
+        field = cls._experiment_field(exp_id) + ".versions"
+        update = {"$addToSet": {field: exp_version}}
+        col = cls._get_collection()
+        try:
+            result = col.update_one({"alias": alias}, update, upsert=True)
+        except DuplicateKeyError:
+            # a concurrent request has just inserted the participant
+            result = col.update_one({"alias": alias}, update)
+        return result.upserted_id is not None or result.modified_count > 0
+
+    @classmethod
+    def participated(cls, alias: str, exp_id: str, exp_version: str = None) -> bool:
+        """Returns *True*, if the (hashed) *alias* participated in the
+        given experiment or, if *exp_version* is given, in that version.
+        """
+        field = cls._experiment_field(exp_id)
+        f = {"alias": alias, field: {"$exists": True}}
+        if exp_version:
+            f[field + ".versions"] = exp_version
+        return cls._get_collection().find_one(f, projection={"_id": True}) is not None
+
+    @classmethod
+    def participations(cls, aliases: list, exp_ids: list) -> dict:
+        """Returns the versions of the given experiments that the
+        (hashed) *aliases* participated in, fetched in a single query.
+
+        Returns:
+            dict: Dictionary of aliases to dictionaries of experiment
+            IDs to lists of versions. Aliases and experiments without
+            participation are missing.
+        """
+        projection = {"_id": False, "alias": True}
+        for exp_id in exp_ids:
+            projection[cls._experiment_field(exp_id) + ".versions"] = True
+
+        col = cls._get_collection()
+        return {
+            doc["alias"]: {
+                exp_id: entry.get("versions", [])
+                for exp_id, entry in doc.get("experiments", {}).items()
+            }
+            for doc in col.find({"alias": {"$in": list(aliases)}}, projection)
+        }
+
+
+class IncrementalDocument(db.Document):
+    """Base class for documents that summarise the datasets of an
+    experiment and are updated incrementally.
+
+    Only main datasets that were saved after the stored watermark are
+    read on update. Datasets from a short period before the watermark are
+    read again, to catch datasets that were written out of order.
+    Unlinked datasets carry no save time and are updated in place during
+    a session, so they are always read in full. Summaries must therefore
+    be idempotent, i.e. reading a dataset twice must not change them.
+    """
+
+    meta = {"abstract": True}
+
+    watermark = db.FloatField()  # save time of the newest main dataset
+    watermark_unlinked = db.ObjectIdField()  # id of the newest unlinked dataset
+    last_update = db.DateTimeField(default=datetime.now)
+
+    WATERMARK_LAG = 60  # seconds
+
+    def reset_watermarks(self):
+        self.watermark = None
+        self.watermark_unlinked = None
+
+    def new_datasets_filter(self, f: dict, dtype: str) -> dict:
+        """Returns a copy of the MongoDB filter *f*, restricted to
+        datasets of type *dtype* that may be new to this document.
+        """
+        f = {**f, "type": dtype}
+        if dtype != DataManager.UNLINKED_DATA and self.watermark is not None:
+            f["exp_save_time"] = {"$gt": self.watermark - self.WATERMARK_LAG}
+        return f
+
+    def save_if_changed(self, force: bool = False):
+        """Saves the document, if it is new or any of its fields changed."""
+        if force or self.pk is None or self._get_changed_fields():
+            self.last_update = datetime.now()
+            self.save()
+
+    @staticmethod
+    def new_datasets_sort(dtype: str) -> list:
+        if dtype == DataManager.UNLINKED_DATA:
+            return [("_id", 1)]
+        return [("exp_save_time", 1)]
+
+    def is_new(self, dataset: dict) -> bool:
+        """Returns *True*, if *dataset* is past the watermarks."""
+        if dataset["type"] == DataManager.UNLINKED_DATA:
+            wm = self.watermark_unlinked
+            return wm is None or dataset["_id"] > wm
+        wm = self.watermark
+        return wm is None or (dataset.get("exp_save_time") or 0) > wm
+
+    def advance_watermark(self, dataset: dict):
+        if dataset["type"] == DataManager.UNLINKED_DATA:
+            if (
+                self.watermark_unlinked is None
+                or dataset["_id"] > self.watermark_unlinked
+            ):
+                self.watermark_unlinked = dataset["_id"]
+        else:
+            save_time = dataset.get("exp_save_time")
+            if save_time is not None and (
+                self.watermark is None or save_time > self.watermark
+            ):
+                self.watermark = save_time
+
+
+class Codebook(IncrementalDocument):
+    """Codebook of an experiment version, merged from the codebooks of
+    all datasets of that version.
+    """
+
+    exp_id = db.StringField(required=True)
+    exp_version = db.StringField(required=True, unique_with="exp_id")
+    entries = db.DictField()
+    label_changes = db.ListField(field=db.DictField())
+
+    LABELS = ["label_top", "label_left", "label_right", "label_bottom", "placeholder"]
+
+    @classmethod
+    def get(cls, exp_id: str, exp_version: str, col, col_unlinked, rebuild=False):
+        """Returns the up-to-date codebook of an experiment version.
+
+        Args:
+            exp_id: Experiment ID.
+            exp_version: Experiment version.
+            col: The user's alfred collection.
+            col_unlinked: The user's collection of unlinked data. If
+                None, unlinked datasets are not read, e.g. because the
+                caller merges their codebooks while reading them anyway.
+            rebuild: If *True*, the codebook is rebuilt from all
+                datasets.
+        """
+        # upsert, so that concurrent requests cannot create duplicates
+        codebook = cls.objects(exp_id=exp_id, exp_version=exp_version).modify(
+            upsert=True, new=True, set_on_insert__entries={}
+        )
+        if rebuild:
+            codebook.entries = {}
+            codebook.label_changes = []
+            codebook.reset_watermarks()
+
+        codebook.update(col, col_unlinked)
+        return codebook
+
+    def _new_datasets(self, col, col_unlinked):
+        f = {"exp_id": self.exp_id, "exp_version": self.exp_version}
+        projection = {
+            "type": True,
+            "exp_data": True,
+            "exp_save_time": True,
+            "alfred_version": True,
+            "exp_author": True,
+            "exp_title": True,
+            "exp_version": True,
+        }
+
+        cursors = []
+        for c, dtype in [
+            (col, DataManager.EXP_DATA),
+            (col_unlinked, DataManager.UNLINKED_DATA),
+        ]:
+            if c is None:
+                continue
+            f_new = self.new_datasets_filter(f, dtype)
+            sort = self.new_datasets_sort(dtype)
+            cursors.append(c.find(f_new, projection, sort=sort))
+
+        return itertools.chain(*cursors)
+
+    def find_label_changes(self, entries: dict, merged: dict = None) -> list:
+        """Compares the labels in *entries* to the merged codebook
+        *merged* (defaults to :attr:`.entries`) and returns a list of
+        changes.
+        """
+        merged = self.entries if merged is None else merged
+        changes = []
+        for name, cb in entries.items():
+            for lab in self.LABELS:
+                old = merged.get(name, "")
+                oldlab = old.get(lab, "") if old else ""
+                newlab = cb.get(lab, "")
+                if not oldlab == newlab:
+                    changes.append(
+                        {"name": name, "label": lab, "old": oldlab, "new": newlab}
+                    )
+        return changes
+
+    def update(self, col, col_unlinked):
+        """Merges the codebooks of all new datasets into the codebook,
+        newer ones overwriting older ones, and saves it, if it changed.
+
+        The labels of the newest dataset are compared to the codebook of
+        all previous datasets, if the newest dataset is new or its
+        codebook differs from the stored one. Differences are stored in
+        :attr:`.label_changes`.
+        """
+        entries = dict(self.entries)
+        last = None
+        last_is_new = False
+        for dataset in self._new_datasets(col, col_unlinked):
+            if last is not None:
+                entries.update(last)
+            last_is_new = self.is_new(dataset)
+            self.advance_watermark(dataset)
+            last = DataManager.extract_codebook_data(dataset)
+
+        if last is not None:
+            changed = any(entries.get(name) != cb for name, cb in last.items())
+            if last_is_new or changed:
+                self.label_changes = (
+                    self.find_label_changes(last, entries) if entries else []
+                )
+            entries.update(last)
+
+        self.entries = entries
+        self.save_if_changed()
+
+
+class FieldnameCatalog(IncrementalDocument):
+    """Catalog of the (flattened) fieldnames of all datasets of one type
+    in an experiment version.
+
+    The catalog is updated incrementally from new datasets. Since
+    datasets may also lose fields, e.g. when they are deleted, the
+    catalog is considered stale after *FIELDNAME_CATALOG_MAX_AGE*
+    seconds and then rebuilt with a full scan.
+    """
+
+    exp_id = db.StringField(required=True)
+    exp_version = db.StringField(required=True)
+    dtype = db.StringField(required=True, unique_with=["exp_id", "exp_version"])
+    fieldnames = db.ListField(field=db.StringField())
+    last_full_scan = db.DateTimeField()
+
+    # large fields that do not contribute to the fieldnames
+    PROJECTION = {"exp_move_history": False, "exp_plugin_queries": False}
+
+    @property
+    def stale(self) -> bool:
+        if self.last_full_scan is None:
+            return True
+        max_age = current_app.config["FIELDNAME_CATALOG_MAX_AGE"]
+        return datetime.now() - self.last_full_scan > timedelta(seconds=max_age)
+
+    @classmethod
+    def get(cls, exp_id: str, exp_version: str, dtype: str, col):
+        """Returns the up-to-date fieldname catalog of an experiment
+        version.
+
+        Args:
+            exp_id: Experiment ID.
+            exp_version: Experiment version.
+            dtype: Type of datasets, e.g. *exp_data* or *unlinked*.
+            col: The collection holding datasets of type *dtype*.
+        """
+        # upsert, so that concurrent requests cannot create duplicates
+        catalog = cls.objects(exp_id=exp_id, exp_version=exp_version, dtype=dtype)
+        catalog = catalog.modify(upsert=True, new=True, set_on_insert__fieldnames=[])
+
+        catalog.update(col)
+        return catalog
+
+    @classmethod
+    def fieldnames_for(cls, exp_id: str, versions: list, dtype: str, col) -> list:
+        """Returns the fieldnames of all datasets of type *dtype* in
+        the given experiment versions, in the same order as a full
+        scan with :meth:`alfred3.data_manager.DataManager.extract_ordered_fieldnames`
+        (main datasets) or :meth:`alfred3.data_manager.DataManager.extract_fieldnames`
+        (all other datasets).
+
+        Args:
+            versions: List of experiment versions. If it contains
+                "all", all versions are included.
+        """
+        if "all" in versions:
+            f = {"exp_id": exp_id, "type": dtype}
+            versions = sorted(col.distinct("exp_version", f))
+
+        fieldnames = {}
+        for version in versions:
+            catalog = cls.get(exp_id, version, dtype, col)
+            fieldnames.update(dict.fromkeys(catalog.fieldnames))
+
+        if dtype == DataManager.EXP_DATA:
+            return cls.order_fieldnames(fieldnames)
+        return list(fieldnames)
+
+    @staticmethod
+    def order_fieldnames(fieldnames) -> list:
+        """Orders flattened fieldnames of main datasets like
+        :meth:`alfred3.data_manager.DataManager.extract_ordered_fieldnames`.
+        """
+        dataset = {**dict.fromkeys(fieldnames), "exp_data": {}}
+        return DataManager.extract_ordered_fieldnames([dataset])
+
+    def update(self, col):
+        """Adds the fieldnames of all new datasets to the catalog and
+        saves it, if it changed. Rebuilds the catalog with a full scan, if it is stale.
+        """
+        full_scan = self.stale
+        if full_scan:
+            self.fieldnames = []
+            self.reset_watermarks()
+
+        f = {"exp_id": self.exp_id, "exp_version": self.exp_version}
+        f = self.new_datasets_filter(f, self.dtype)
+        sort = self.new_datasets_sort(self.dtype)
+
+        fieldnames = dict.fromkeys(self.fieldnames)
+        for dataset in col.find(f, self.PROJECTION, sort=sort):
+            self.advance_watermark(dataset)
+            dataset.setdefault("exp_data", {})
+            fieldnames.update(DataManager.flatten(dataset))
+
+        self.fieldnames = list(fieldnames)
+        if full_scan:
+            self.last_full_scan = datetime.now()
+        self.save_if_changed(force=full_scan)
+
+
+class CountedSession(db.Document):
+    """A session that is counted in the :class:`.ExperimentStatistics`
+    of its experiment, identified by the ID of its main dataset.
+
+    Datasets are read again whenever they are saved, so these records
+    make counting idempotent: A session is counted once when its record
+    is inserted and once more as finished, when its record is marked as
+    finished. Both are single atomic operations on the uniquely indexed
+    record, so that concurrent updates cannot count a session twice.
+    """
+
+    exp_id = db.StringField(required=True)
+    dataset_id = db.DynamicField(required=True)
+    finished = db.BooleanField(default=False)
+
+    meta = {"indexes": [{"fields": ["exp_id", "dataset_id"], "unique": True}]}
+
+    @classmethod
+    def count(cls, exp_id: str, datasets: list) -> list:
+        """Records the given main datasets of an experiment.
+
+        Returns:
+            list: The datasets that have not been counted before, or
+            that have not been counted as finished before, as tuples of
+            the dataset, *True* if the session is new and *True* if it
+            is newly finished.
+        """
+        col = cls._get_collection()
+        ids = [dataset["_id"] for dataset in datasets]
+        f = {"exp_id": exp_id, "dataset_id": {"$in": ids}}
+        projection = {"_id": False, "dataset_id": True, "finished": True}
+        known = {r["dataset_id"]: r["finished"] for r in col.find(f, projection)}
+
+        counted = []
+        for dataset in datasets:
+            key = {"exp_id": exp_id, "dataset_id": dataset["_id"]}
+            finished = dataset.get("exp_finished") is True
+            if dataset["_id"] not in known:
+                try:
+                    update = {"$setOnInsert": {"finished": finished}}
+                    result = col.update_one(key, update, upsert=True)
+                    if result.upserted_id is not None:
+                        counted.append((dataset, True, finished))
+                        continue
+                except DuplicateKeyError:
+                    # a concurrent update has just counted the session
+                    pass
+            elif known[dataset["_id"]]:
+                continue
+
+            if finished:
+                update = {"$set": {"finished": True}}
+                result = col.update_one({**key, "finished": False}, update)
+                if result.modified_count:
+                    counted.append((dataset, False, True))
+
+        return counted
+
+
+class ExperimentStatistics(db.Document):
+    """Dataset statistics of an experiment: Number of all and of
+    finished sessions, in total and per version, alfred versions used
+    by finished sessions and the first and last session start time.
+
+    Only main datasets that were saved after the watermark, the latest
+    save time seen so far, are read on update. Datasets from
+    *WATERMARK_LAG* seconds before the watermark are read again, to
+    catch datasets that were written out of order. A session is often
+    saved for the first time long after it started, and finished
+    sessions may be saved again, so every dataset can be read more than
+    once. :class:`.CountedSession` records make sure that each session
+    is counted once in total and once as finished.
+
+    Since deleted datasets are not noticed, the statistics can be
+    rebuilt from all datasets.
+    """
+
+    exp_id = db.StringField(required=True, unique=True)
+    watermark = db.FloatField()
+    total = db.IntField(default=0)
+    fin = db.IntField(default=0)
+    first = db.FloatField()
+    last = db.FloatField()
+    alfred_versions = db.ListField(field=db.StringField())
+
+    # versions may contain dots, which are not allowed in keys
+    versions = db.ListField(field=db.DictField())  # version, total, fin
+    last_update = db.DateTimeField(default=datetime.now)
+
+    WATERMARK_LAG = 60  # seconds
+    BATCH_SIZE = 1000  # datasets per lookup of counted sessions
+
+    # fields needed for counting
+    PROJECTION = {
+        "exp_version": True,
+        "exp_start_time": True,
+        "exp_save_time": True,
+        "exp_finished": True,
+        "alfred_version": True,
+    }
+
+    @classmethod
+    def get(cls, exp_id: str, col, rebuild=False):
+        """Returns the up-to-date statistics of an experiment.
+
+        Args:
+            exp_id: Experiment ID.
+            col: The user's alfred collection.
+            rebuild: If *True*, the statistics are rebuilt from all
+                datasets.
+        """
+        stats = cls.objects(exp_id=exp_id).first()
+        if stats is None:
+            # upsert, so that concurrent requests cannot create duplicates
+            stats = cls.objects(exp_id=exp_id).modify(
+                upsert=True, new=True, set_on_insert__total=0
+            )
+        if rebuild:
+            CountedSession.objects(exp_id=exp_id).delete()
+            stats.reset()
+            stats.save()
+
+        stats.update(col)
+        return stats
+
+    @classmethod
+    def for_experiments(cls, exp_ids: list) -> dict:
+        """Returns a dictionary of experiment IDs to the stored
+        statistics of these experiments, fetched in a single query.
+        Experiments without stored statistics are missing.
+        """
+        return {stats.exp_id: stats for stats in cls.objects(exp_id__in=exp_ids)}
+
+    def reset(self):
+        self.watermark = None
+        self.total = 0
+        self.fin = 0
+        self.first = None
+        self.last = None
+        self.alfred_versions = []
+        self.versions = []
+
+    def new_datasets_filter(self) -> dict:
+        """Returns the filter for the main datasets that are read on
+        update.
+        """
+        f = {"exp_id": self.exp_id, "type": DataManager.EXP_DATA}
+        if self.watermark is not None:
+            f["exp_save_time"] = {"$gt": self.watermark - self.WATERMARK_LAG}
+        return f
+
+    def update(self, col):
+        """Counts the sessions of all new main datasets and saves the
+        statistics, if they changed.
+        """
+        inc = {"total": 0, "fin": 0}
+        versions = {}
+        alfred_versions = set()
+        first, last, watermark = self.first, self.last, self.watermark
+
+        datasets = col.find(self.new_datasets_filter(), self.PROJECTION)
+        for chunk in chunked(datasets, self.BATCH_SIZE):
+            for dataset, new, finished in CountedSession.count(self.exp_id, chunk):
+                version = versions.setdefault(
+                    dataset.get("exp_version"), {"total": 0, "fin": 0}
+                )
+                if new:
+                    inc["total"] += 1
+                    version["total"] += 1
+                if finished:
+                    inc["fin"] += 1
+                    version["fin"] += 1
+                    if dataset.get("alfred_version") is not None:
+                        alfred_versions.add(dataset["alfred_version"])
+
+            for dataset in chunk:
+                start = dataset.get("exp_start_time")
+                if start is not None:
+                    first = start if first is None else min(first, start)
+                    last = start if last is None else max(last, start)
+                save = dataset.get("exp_save_time")
+                if save is not None:
+                    watermark = save if watermark is None else max(watermark, save)
+
+        update = {"$inc": {k: v for k, v in inc.items() if v}, "$min": {}, "$max": {}}
+        if alfred_versions:
+            update["$addToSet"] = {
+                "alfred_versions": {"$each": sorted(alfred_versions)}
+            }
+        if first != self.first:
+            update["$min"]["first"] = first
+        if last != self.last:
+            update["$max"]["last"] = last
+        if watermark != self.watermark:
+            update["$max"]["watermark"] = watermark
+        update = {k: v for k, v in update.items() if v}
+
+        if update:
+            # atomic increments, so that concurrent updates add up
+            stats = self._get_collection()
+            for version, counts in versions.items():
+                # versions are stored in a list and updated in place
+                entry = {"version": version, "total": 0, "fin": 0}
+                f = {"_id": self.pk, "versions.version": {"$ne": version}}
+                stats.update_one(f, {"$push": {"versions": entry}})
+                f = {"_id": self.pk, "versions.version": version}
+                counts = {f"versions.$.{k}": v for k, v in counts.items() if v}
+                stats.update_one(f, {"$inc": counts})
+
+            update["$set"] = {"last_update": datetime.now()}
+            stats.update_one({"_id": self.pk}, update)
+            self.reload()
+
+        self.last_update = datetime.now()
+
+    def summary(self) -> dict:
+        """Returns the statistics as a dictionary.
+
+        Returns:
+            dict: Dictionary with the keys *total*, *fin*, *versions*
+            (dictionary of experiment versions to dictionaries with the
+            keys *total* and *fin*), *alfred_versions* and *activity*
+            (dictionary with the *first* and *last* session start time,
+            or None if there are no datasets).
+        """
+        return {
+            "total": self.total,
+            "fin": self.fin,
+            "versions": {
+                v["version"]: {"total": v["total"], "fin": v["fin"]}
+                for v in self.versions
+            },
+            "alfred_versions": sorted(self.alfred_versions),
+            "activity": {"first": self.first, "last": self.last}
+            if self.first is not None
+            else None,
+        }
+
+
+class ExportJob(db.Document):
+    """An export that is written to a file in the background.
+
+    Files are stored in the *exports* directory of the app's instance
+    path and removed, together with their job, after
+    *EXPORT_JOB_MAX_AGE* seconds.
+    """
+
+    username = db.StringField(required=True)
+    exp_id = db.StringField(required=True)
+    download_name = db.StringField(required=True)
+    mimetype = db.StringField(default="application/zip")
+    status = db.StringField(default="running")  # running, done or failed
+    error = db.StringField()
+    created = db.DateTimeField(default=datetime.now)
+    finished = db.DateTimeField()
+
+    @property
+    def path(self) -> Path:
+        suffix = "".join(Path(self.download_name).suffixes)
+        return Path(current_app.instance_path) / "exports" / f"{self.id}{suffix}"
+
+    def fail(self, error: str):
+        self.status = "failed"
+        self.error = error
+        self.finished = datetime.now()
+        self.save()
+        self.path.unlink(missing_ok=True)
+
+    def delete(self, *args, **kwargs):
+        self.path.unlink(missing_ok=True)
+        super().delete(*args, **kwargs)
+
+    @classmethod
+    def remove_expired(cls):
+        max_age = current_app.config["EXPORT_JOB_MAX_AGE"]
+        limit = datetime.now() - timedelta(seconds=max_age)
+        for job in cls.objects(created__lt=limit):
+            job.delete()
@@ -1,3 +1,4 @@
+import click
 from flask import (
     Blueprint,
     current_app,
@@ -110,7 +111,7 @@ def account():
 
     if form.validate_on_submit():  # if all field are filled out correctly
         if current_user.username != form.username.data:
-            for exp in WebExperiment.objects(author=current_user.username):
+            for exp in WebExperiment.light(author=current_user.username):
                 exp.author = form.username.data
                 exp.save()
 
@@ -178,3 +179,15 @@ def reset_password(token):
         return redirect(url_for("users.login"))
 
     return render_template("reset_password.html", title="Reset Password", form=form)
+
+
+@users.cli.command("create-indexes")
+@click.argument("usernames", nargs=-1)
+def create_indexes(usernames):
+    """Creates missing indexes on the alfred collections of the given
+    users, or of all users.
+    """
+    accounts = User.objects(username__in=usernames) if usernames else User.objects
+    for user in accounts:
+        created = user.create_indexes()
+        click.echo(f"{user.username}: {len(created)} indexes created.")
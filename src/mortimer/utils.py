@@ -1,14 +1,19 @@
+import collections
 import copy
+import hashlib
 import importlib.resources as res
 import json
 import os
 import re
 import subprocess
+import threading
+import time
 from datetime import datetime
-from typing import Iterator
+from pathlib import Path
 from uuid import uuid4
 
 import pymongo
+from alfred3.data_manager import DataManager
 from cryptography.fernet import Fernet
 from flask import current_app, render_template, url_for
 from flask_login import current_user
@@ -19,22 +24,222 @@ from mortimer import mail
 from .static import json as jdat
 
 
-def get_plugin_data_queries(exp) -> Iterator[dict]:
+class StampedCache:
+    """A small, thread-safe LRU cache. Every entry is stored with a
+    stamp, e.g. the time of the newest relevant change, and is only
+    returned for the same stamp.
+
+    Args:
+        maxsize: Maximum number of entries.
+        ttl: Optional time to live of entries in seconds.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, stamp=None, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] != stamp:
+                return default
+            if entry[2] is not None and entry[2] < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, stamp=None):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (stamp, value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_plugin_queries_cache = StampedCache()
+
+
+def plugin_queries_pipeline(exp_id: str) -> list:
+    """Returns the aggregation pipeline used by
+    :func:`find_plugin_data_queries`.
+    """
+    return [
+        {
+            "$match": {
+                "exp_id": exp_id,
+                "type": DataManager.EXP_DATA,
+                "exp_plugin_queries": {"$exists": True},
+            }
+        },
+        {"$project": {"exp_plugin_queries": True}},
+        {"$unwind": {"path": "$exp_plugin_queries", "includeArrayIndex": "i"}},
+        {"$match": {"exp_plugin_queries": {"$nin": [None, {}]}}},
+        {
+            "$group": {
+                "_id": "$exp_plugin_queries",
+                "first_doc": {"$min": "$_id"},
+                "first_index": {"$min": "$i"},
+            }
+        },
+        {"$sort": {"first_doc": 1, "first_index": 1}},
+    ]
+
+
+def find_plugin_data_queries(col, exp_id: str) -> list:
+    """Finds the distinct plugin data queries of an experiment's
+    datasets with a server-side aggregation.
+
+    Queries are returned in the order in which they first occur.
+    """
+    pipeline = plugin_queries_pipeline(exp_id)
+    return [entry["_id"] for entry in col.aggregate(pipeline)]
+
+
+def get_plugin_data_queries(exp) -> list[dict]:
+    """Returns the distinct plugin data queries of an experiment.
+
+    The result is cached per experiment and recomputed when a dataset
+    of the experiment has been saved since.
+    """
     db = get_user_collection()
-    f = {"exp_id": str(exp.id), "exp_plugin_queries": {"$exists": True, "$ne": {}}}
-    cursor = db.find(f, projection={"_id": False, "exp_plugin_queries": True})
-
-    out = []
-    for doc in cursor:
-        query_list = doc.get("exp_plugin_queries", None)
-        if not query_list:
-            continue
-        for q in query_list:
-            if not q:
-                continue
-            if q not in out:
-                out.append(q)
-                yield q
+    exp_id = str(exp.id)
+
+    newest = db.find_one(
+        {"exp_id": exp_id, "type": DataManager.EXP_DATA},
+        projection={"_id": False, "exp_save_time": True},
+        sort=[("exp_save_time", pymongo.DESCENDING)],
+    )
+    stamp = (db.full_name, newest.get("exp_save_time") if newest else None)
+
+    queries = _plugin_queries_cache.get(exp_id, stamp)
+    if queries is None:
+        queries = find_plugin_data_queries(db, exp_id)
+        _plugin_queries_cache.set(exp_id, queries, stamp=stamp)
+
+    return copy.deepcopy(queries)
+
+
+def paginated_find(col, filter: dict = None, page_size: int = 1000, **kwargs):
+    """Yields the documents of a find query page by page.
+
+    Pages are fetched with keyset pagination on *_id*: Every page is a
+    separate query for documents with an *_id* greater than the last
+    one, so that no server-side cursor is kept open between pages, e.g.
+    while a slow client downloads an export. Queries with their own
+    sort order or a projection without *_id* cannot be paginated this
+    way, just like queries with their own *skip* or *limit*. They are
+    run with a single cursor that fetches batches of *page_size*
+    documents.
+
+    Args:
+        col: The collection.
+        filter: The query filter.
+        page_size: Number of documents per page.
+        **kwargs: Further arguments for :meth:`pymongo.collection.Collection.find`.
+    """
+    filter = filter or {}
+    projection = kwargs.get("projection")
+    without_id = isinstance(projection, dict) and not projection.get("_id", True)
+    if without_id or {"sort", "skip", "limit"} & set(kwargs):
+        yield from col.find(filter, batch_size=page_size, **kwargs)
+        return
+
+    page_filter = filter
+    while True:
+        page = list(col.find(page_filter, sort=[("_id", 1)], limit=page_size, **kwargs))
+        if not page:
+            return
+        # read before yielding, because callers may modify the documents
+        last_id = page[-1]["_id"]
+        yield from page
+        if len(page) < page_size:
+            return
+        page_filter = {"$and": [filter, {"_id": {"$gt": last_id}}]}
+
+
+def _winning_plans(explanation):
+    if isinstance(explanation, dict):
+        for key, value in explanation.items():
+            if key == "winningPlan":
+                yield value
+            else:
+                yield from _winning_plans(value)
+    elif isinstance(explanation, list):
+        for value in explanation:
+            yield from _winning_plans(value)
+
+
+def _plan_stages(plan) -> list:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for key, value in plan.items():
+            if key in ["inputStage", "inputStages", "queryPlan", "shards"]:
+                stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+
+def _execution_stat(explanation, key: str) -> int:
+    if isinstance(explanation, dict):
+        values = [_execution_stat(v, key) for v in explanation.values()]
+        if isinstance(explanation.get(key), int):
+            values.append(explanation[key])
+        return max(values, default=0)
+    elif isinstance(explanation, list):
+        return max((_execution_stat(v, key) for v in explanation), default=0)
+    return 0
+
+
+def summarize_explanation(explanation: dict) -> dict:
+    """Summarizes the output of MongoDB's *explain* command.
+
+    Returns:
+        dict: Dictionary with the keys *stages* (stages of the winning
+        plans, outermost first), *collscan* (*True*, if any winning plan
+        scans the whole collection), *docs_examined* and *keys_examined*.
+    """
+    stages = []
+    for plan in _winning_plans(explanation):
+        stages.extend(_plan_stages(plan))
+    return {
+        "stages": stages,
+        "collscan": "COLLSCAN" in stages,
+        "docs_examined": _execution_stat(explanation, "totalDocsExamined"),
+        "keys_examined": _execution_stat(explanation, "totalKeysExamined"),
+    }
+
+
+def explain_query(
+    col, filter: dict = None, sort: list = None, pipeline: list = None
+) -> dict:
+    """Explains a find query or, if *pipeline* is given, an aggregation
+    on *col* and returns a summary, see :func:`summarize_explanation`.
+    """
+    if pipeline is not None:
+        cmd = {"aggregate": col.name, "pipeline": pipeline, "cursor": {}}
+    else:
+        cmd = {"find": col.name, "filter": filter or {}}
+        if sort:
+            cmd["sort"] = dict(sort)
+    explanation = col.database.command("explain", cmd, verbosity="executionStats")
+    return summarize_explanation(explanation)
 
 
 def sanitize_db_cred():
@@ -373,10 +578,41 @@ def replace_all_patterns(file):
         replace_patterns(file, dct, write=True)
 
 
+def script_hash(script: str) -> str:
+    return hashlib.sha256(script.encode("utf-8")).hexdigest()
+
+
+def script_store_path(digest: str) -> Path:
+    """Returns the path of a script in the content-addressed script
+    store in the instance folder.
+    """
+    return Path(current_app.instance_path) / "scripts" / digest[:2] / f"{digest}.py"
+
+
+def store_script(script: str) -> str:
+    """Stores a script in the script store, unless it is already there,
+    and returns its hash.
+    """
+    digest = script_hash(script)
+    path = script_store_path(digest)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{uuid4()}.tmp")
+        tmp.write_text(script, encoding="utf-8")
+        tmp.replace(path)
+    return digest
+
+
+def load_script(digest: str) -> str:
+    return script_store_path(digest).read_text(encoding="utf-8")
+
+
 class ScriptString:
     def __init__(self, exp, script=None):
         self.exp = exp
-        self.name = self.exp.script_name if self.exp.script else str(uuid4()) + ".py"
+        self.name = (
+            self.exp.script_name if self.exp.has_script else str(uuid4()) + ".py"
+        )
         self.script = script
 
     def parse(self):
@@ -391,7 +627,7 @@ class ScriptString:
 
     def save(self):
         # saves the script to the experiment and to the file system, if changes were made
-        if (self.exp.script != self.script) or not os.path.exists(
+        if (self.exp.script_hash != script_hash(self.script)) or not os.path.exists(
             self.exp.script_fullpath
         ):
             try:
@@ -405,7 +641,7 @@ class ScriptString:
             self.exp.last_update = datetime.utcnow
 
             with open(self.exp.script_fullpath, "w", encoding="utf-8") as f:
-                f.write(self.exp.script)
+                f.write(self.script)
 
             self.exp.save()
 
@@ -1,36 +1,59 @@
 # pylint: disable=no-member
 import collections
+import copy
 import csv
-import hashlib
+import importlib.util
 import io
-import json
+import logging
 import os
-import random
 import re
 import shutil
+import threading
+import unicodedata
 import zipfile
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
+from urllib.parse import quote
 from uuid import uuid4
 
+import pymongo
 from alfred3 import data_manager
+from bson import ObjectId
 from flask import (
     Blueprint,
+    Response,
     abort,
     current_app,
     flash,
+    jsonify,
     make_response,
     redirect,
     render_template,
     request,
     send_file,
     session,
+    stream_with_context,
     url_for,
 )
 from flask_login import current_user, login_required
 from werkzeug.utils import secure_filename
 
-from mortimer.export import make_str_bytes
+from mortimer.export import (
+    ARROW_FORMATS,
+    XLSX_MIMETYPE,
+    ExportBundle,
+    column_projection,
+    csv_chunks,
+    decrypt_parallel,
+    encode_chunks,
+    gzip_chunks,
+    json_chunks,
+    make_str_bytes,
+    shuffled,
+    to_arrow,
+    to_xlsx,
+    zip_chunks,
+)
 from mortimer.forms import (
     ExperimentConfigForm,
     ExperimentScriptForm,
@@ -38,19 +61,33 @@ from mortimer.forms import (
     NewScriptForm,
     WebExperimentForm,
 )
-from mortimer.models import Participant, User, WebExperiment
+from mortimer.models import (
+    Codebook,
+    ExperimentStatistics,
+    ExportJob,
+    FieldnameCatalog,
+    Participant,
+    User,
+    WebExperiment,
+)
 from mortimer.utils import (
     ScriptFile,
     ScriptString,
+    StampedCache,
     create_fernet,
     display_directory,
+    explain_query,
     get_alfred_db,
     get_plugin_data_queries,
     get_user_collection,
+    paginated_find,
+    plugin_queries_pipeline,
 )
 
 web_experiments = Blueprint("web_experiments", __name__)
 
+JSON_MIMETYPES = {"json": "application/json", "ndjson": "application/x-ndjson"}
+
 
 @web_experiments.route("/experiment/new", methods=["GET", "POST"])
 @login_required
@@ -117,7 +154,11 @@ def new_experiment():
 @web_experiments.route("/<username>/<path:exp_title>", methods=["POST", "GET"])
 @login_required
 def experiment(username, exp_title):
-    exp = WebExperiment.objects.get_or_404(  # pylint: disable=no-member
+    # the script is only needed to process an upload
+    experiments = (
+        WebExperiment.objects if request.method == "POST" else WebExperiment.light
+    )
+    exp = experiments.get_or_404(  # pylint: disable=no-member
         title=exp_title, author=username
     )
     if exp.author != current_user.username:
@@ -140,41 +181,26 @@ def experiment(username, exp_title):
     # Query Database
     db = get_user_collection()
 
-    f_id = {"exp_id": str(exp.id)}
-    f_fin = {"exp_finished": True}
-    f_ver = {"exp_version": exp.version}
-
-    # Used versions
-    alfred_versions = db.distinct("alfred_version", {**f_id, **f_fin})
-    alfred_versions.sort()
+    rebuild = request.args.get("rebuild") == "true"
+    stats = ExperimentStatistics.get(str(exp.id), db, rebuild=rebuild).summary()
+    alfred_versions = stats["alfred_versions"]
 
     # Number of datasets
+    versions = stats["versions"]
+    current = versions.get(exp.version, {"total": 0, "fin": 0})
     n = {}
-    n["total"] = db.count_documents(f_id)
-    n["fin"] = db.count_documents({**f_id, **f_fin})
+    n["total"] = stats["total"]
+    n["fin"] = stats["fin"]
     n["unfin"] = n["total"] - n["fin"]
-    n["current_ver"] = db.count_documents({**f_id, **f_ver})
-    n["fin_current_ver"] = db.count_documents({**f_fin, **f_id, **f_ver})
+    n["current_ver"] = current["total"]
+    n["fin_current_ver"] = current["fin"]
     n["unfin_current_ver"] = n["current_ver"] - n["fin_current_ver"]
-    n["individual_versions"] = {}
-
-    # Number of datasets per version
-    for v in exp.available_versions:
-        f_ver = {"exp_version": v, **f_id}
-        entry = {
-            "total": db.count_documents(f_ver),
-            "fin": db.count_documents({**f_fin, **f_ver}),
-        }
-        n["individual_versions"][v] = entry
+    n["individual_versions"] = {
+        v: versions.get(v, {"total": 0, "fin": 0}) for v in exp.available_versions
+    }
 
     # start time
-    group = {
-        "_id": 1,
-        "first": {"$min": "$exp_start_time"},
-        "last": {"$max": "$exp_start_time"},
-    }
-    pipe = [{"$match": f_id}, {"$group": group}]
-    times = list(db.aggregate(pipe))
+    times = [stats["activity"]] if stats["activity"] else []
 
     activity = {}
     if times:
@@ -289,6 +315,11 @@ def experiment_script(username, exp_title):
     # pre-populate form
     form.script.data = exp.script
     form.version.data = exp.version
+    if exp.has_script and form.script.data is None:
+        flash(
+            "Your script.py could not be found. Please upload it again.",
+            "danger",
+        )
 
     return render_template(
         "experiment_script.html",
@@ -305,9 +336,7 @@ def experiment_script(username, exp_title):
 @login_required
 def delete_experiment(username, experiment_title):
     # pylint: disable=no-member
-    experiment = WebExperiment.objects.get_or_404(
-        title=experiment_title, author=username
-    )
+    experiment = WebExperiment.light.get_or_404(title=experiment_title, author=username)
 
     if experiment.author != current_user.username:
         abort(403)
@@ -368,9 +397,7 @@ def validate_zipfile_filenames(z: zipfile.ZipFile) -> bool:
 @login_required
 def upload_resources(username, experiment_title, relative_path):
     # pylint: disable=no-member
-    experiment = WebExperiment.objects.get_or_404(
-        title=experiment_title, author=username
-    )
+    experiment = WebExperiment.light.get_or_404(title=experiment_title, author=username)
     if experiment.author != current_user.username:
         abort(403)
 
@@ -430,9 +457,7 @@ def upload_resources(username, experiment_title, relative_path):
 @login_required
 def manage_resources(username, experiment_title):
     # pylint: disable=no-member
-    experiment = WebExperiment.objects.get_or_404(
-        title=experiment_title, author=username
-    )
+    experiment = WebExperiment.light.get_or_404(title=experiment_title, author=username)
     if experiment.author != current_user.username:
         abort(403)
 
@@ -486,11 +511,35 @@ def user_experiments(username):
         abort(403)
 
     # pylint: disable=no-member
-    experiments = WebExperiment.objects(author_id=user.id).order_by("-last_update")
+    page = request.args.get("page", 1, type=int)
+    experiments = (
+        WebExperiment.objects(author_id=user.id)
+        .only("id", "title", "author", "active", "last_update", "date_created")
+        .order_by("-last_update")
+        .paginate(page=page, per_page=current_app.config["EXPERIMENTS_PER_PAGE"])
+    )
+    exp_ids = [str(exp.id) for exp in experiments.items]
+    stats = ExperimentStatistics.for_experiments(exp_ids)
+
+    # recount missing and outdated statistics, oldest first. Their number
+    # is bounded, so that the page stays fast. The rest show their age.
+    max_age = timedelta(seconds=current_app.config["STATISTICS_MAX_AGE"])
+    outdated = [
+        exp_id
+        for exp_id in exp_ids
+        if exp_id not in stats or datetime.now() - stats[exp_id].last_update > max_age
+    ]
+    outdated.sort(key=lambda i: stats[i].last_update if i in stats else datetime.min)
+    outdated = outdated[: current_app.config["STATISTICS_UPDATES_PER_PAGE"]]
+    if outdated:
+        col = get_user_collection()
+        for exp_id in outdated:
+            stats[exp_id] = ExperimentStatistics.get(exp_id, col)
 
     return render_template(
         "user_experiments.html",
         experiments=experiments,
+        stats=stats,
         user=user,
         secure_filename=secure_filename,
     )
@@ -502,9 +551,7 @@ def user_experiments(username):
 @login_required
 def delete_all_files(username, experiment_title):
     # pylint: disable=no-member
-    experiment = WebExperiment.objects.get_or_404(
-        title=experiment_title, author=username
-    )
+    experiment = WebExperiment.light.get_or_404(title=experiment_title, author=username)
     if experiment.author != current_user.username:
         abort(403)
 
@@ -545,9 +592,7 @@ def new_directory(username: str, experiment_title: str, relative_path: str = Non
     name = request.form["new_directory"]
 
     # pylint: disable=no-member
-    experiment = WebExperiment.objects.get_or_404(
-        title=experiment_title, author=username
-    )
+    experiment = WebExperiment.light.get_or_404(title=experiment_title, author=username)
 
     if experiment.author != current_user.username:
         abort(403)
@@ -599,9 +644,7 @@ def new_directory(username: str, experiment_title: str, relative_path: str = Non
 @login_required
 def delete_directory(username, experiment_title, relative_path):
     # pylint: disable=no-member
-    experiment = WebExperiment.objects.get_or_404(
-        title=experiment_title, author=username
-    )
+    experiment = WebExperiment.light.get_or_404(title=experiment_title, author=username)
 
     if experiment.author != current_user.username:
         abort(403)
@@ -630,9 +673,7 @@ def delete_directory(username, experiment_title, relative_path):
 @login_required
 def delete_file(username, experiment_title, relative_path):
     # pylint: disable=no-member
-    experiment = WebExperiment.objects.get_or_404(
-        title=experiment_title, author=username
-    )
+    experiment = WebExperiment.light.get_or_404(title=experiment_title, author=username)
 
     if experiment.author != current_user.username:
         abort(403)
@@ -654,7 +695,7 @@ def delete_file(username, experiment_title, relative_path):
 )
 @login_required
 def export(username, experiment_title):
-    experiment = WebExperiment.objects.get_or_404(  # pylint: disable=no-member
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
         title=experiment_title, author=username
     )
     if experiment.author != current_user.username:
@@ -664,6 +705,13 @@ def export(username, experiment_title):
         dtype, delim = request.values.get("submit").split(".")
         versionlist = request.values.getlist("select-version")
         versions = "$VERSIONSEP$".join(versionlist)
+        compression = request.values.get("compression") or None
+        filters = {
+            "finished": request.values.get("finished") or None,
+            "start_from": request.values.get("start_from") or None,
+            "start_to": request.values.get("start_to") or None,
+            "condition": request.values.getlist("condition") or None,
+        }
 
         if dtype == "main":
             return redirect(
@@ -673,6 +721,9 @@ def export(username, experiment_title):
                     username=experiment.author,
                     delim=delim,
                     versions=versions,
+                    compression=compression,
+                    columns=request.values.getlist("columns") or None,
+                    **filters,
                 )
             )
 
@@ -708,6 +759,8 @@ def export(username, experiment_title):
                     username=experiment.author,
                     delim=delim,
                     versions=versions,
+                    compression=compression,
+                    **filters,
                 )
             )
 
@@ -719,6 +772,7 @@ def export(username, experiment_title):
                     username=experiment.author,
                     delim=delim,
                     versions=versions,
+                    compression=compression,
                 )
             )
 
@@ -728,7 +782,23 @@ def export(username, experiment_title):
                     "web_experiments.export_full_data",
                     experiment_title=experiment.title,
                     username=experiment.author,
+                    delim=delim,
+                    versions=versions,
+                    compression=compression,
+                    **filters,
+                )
+            )
+
+        elif dtype == "bundle":
+            return redirect(
+                url_for(
+                    "web_experiments.export_bundle",
+                    experiment_title=experiment.title,
+                    username=experiment.author,
+                    delim=delim,
                     versions=versions,
+                    background=request.values.get("background") or None,
+                    **filters,
                 )
             )
 
@@ -753,7 +823,10 @@ def export(username, experiment_title):
                     "web_experiments.export_plugin_data",
                     experiment_title=experiment.title,
                     username=experiment.author,
+                    delim=delim,
                     versions=versions,
+                    compression=compression,
+                    background=request.values.get("background") or None,
                 )
             )
 
@@ -762,8 +835,209 @@ def export(username, experiment_title):
     for q in queries:
         query_tuples.append((q["title"], q["type"]))
 
+    # options for session filters and column selection
+    db = get_user_collection()
+    f = {"exp_id": str(experiment.id), "type": data_manager.DataManager.EXP_DATA}
+    conditions = sorted(str(c) for c in db.distinct("exp_condition", f) if c)
+    fieldnames = FieldnameCatalog.fieldnames_for(
+        str(experiment.id), ["all"], data_manager.DataManager.EXP_DATA, db
+    )
+
+    jobs = ExportJob.objects(
+        username=current_user.username, exp_id=str(experiment.id)
+    ).order_by("-created")
+
     return render_template(
-        "export.html", experiment=experiment, plugin_queries=query_tuples
+        "export.html",
+        experiment=experiment,
+        plugin_queries=query_tuples,
+        conditions=conditions,
+        fieldnames=fieldnames,
+        jobs=jobs,
+    )
+
+
+def session_filter(f: dict) -> dict:
+    """Updates the MongoDB filter *f* for experiment datasets with the
+    session filters given as query parameters and returns it.
+
+    Supported query parameters:
+
+    * *finished*: If given, only finished sessions are included.
+    * *start_from*, *start_to*: Dates (YYYY-MM-DD) of the first and last
+      day of the session start time range. Both are inclusive.
+    * *condition*: Experiment condition(s) to include. Can be given
+      multiple times.
+    """
+    if request.args.get("finished"):
+        f["exp_finished"] = True
+
+    start = {}
+    try:
+        if request.args.get("start_from"):
+            start_from = datetime.strptime(request.args["start_from"], "%Y-%m-%d")
+            start["$gte"] = start_from.timestamp()
+        if request.args.get("start_to"):
+            start_to = datetime.strptime(request.args["start_to"], "%Y-%m-%d")
+            start["$lt"] = (start_to + timedelta(days=1)).timestamp()
+    except ValueError:
+        abort(400)
+    if start:
+        f["exp_start_time"] = start
+
+    conditions = request.args.getlist("condition")
+    if conditions:
+        f["exp_condition"] = {"$in": conditions}
+
+    return f
+
+
+def decrypt_documents(docs, key: bytes = None):
+    """Decrypts documents with the current user's encryption key.
+
+    Decryption is spread over a pool of worker processes, see
+    :func:`mortimer.export.decrypt_parallel`. Returns an iterator over
+    the decrypted documents, in their original order.
+
+    Args:
+        docs: Iterable of documents.
+        key: Decrypted encryption key. Must be given, if the documents
+            are decrypted outside of a request, e.g. in a background
+            job.
+    """
+    if key is None:
+        fern = create_fernet()
+        key = fern.decrypt(current_user.encryption_key)
+    return decrypt_parallel(
+        docs,
+        key=key,
+        processes=current_app.config["EXPORT_DECRYPTION_PROCESSES"],
+        chunk_size=current_app.config["EXPORT_DECRYPTION_CHUNK_SIZE"],
+    )
+
+
+def compress(chunks, filename: str, mimetype: str):
+    """Compresses a download on the fly, if the request has a query
+    parameter *compression* with the value "gzip" or "zip".
+
+    Args:
+        chunks: Iterable of str or bytes chunks of the file's content.
+        filename: Download name of the uncompressed file.
+        mimetype: Mimetype of the uncompressed file.
+
+    Returns:
+        A tuple of the (compressed) bytes chunks, filename and mimetype.
+    """
+    compression = request.args.get("compression")
+    if compression == "gzip":
+        body = gzip_chunks(chunks)
+        filename = f"{filename}.gz"
+        mimetype = "application/gzip"
+    elif compression == "zip":
+        body = zip_chunks([(filename, chunks)])
+        filename = f"{Path(filename).stem}.zip"
+        mimetype = "application/zip"
+    else:
+        body = encode_chunks(chunks)
+    return body, filename, mimetype
+
+
+def send_stream(chunks, filename: str, mimetype: str):
+    """Streams a download to the client while it is being produced,
+    compressed according to the request, see :func:`.compress`.
+
+    Args:
+        chunks: Iterable of str or bytes chunks of the file's content.
+        filename: Download name of the uncompressed file.
+        mimetype: Mimetype of the uncompressed file.
+    """
+    body, filename, mimetype = compress(chunks, filename, mimetype)
+
+    response = Response(stream_with_context(body), mimetype=mimetype)
+
+    # non-ascii filenames are sent according to RFC 5987, like send_file does
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        quoted = quote(filename, safe="!#$&+^`|~")
+        response.headers.set(
+            "Content-Disposition",
+            "attachment",
+            filename=simple,
+            **{"filename*": f"UTF-8''{quoted}"},
+        )
+    else:
+        response.headers.set("Content-Disposition", "attachment", filename=filename)
+    response.cache_control.max_age = 1
+
+    return response
+
+
+def send_columnar(rows, fieldnames, fmt: str, filename: str):
+    """Sends flat datasets as a columnar parquet or feather file.
+
+    Args:
+        rows: Iterable of flat datasets. It is consumed once, the column
+            types are inferred from the first datasets.
+        fieldnames: The columns to include, in order. If None, all
+            columns are included in the order in which they appear.
+        fmt: Either "parquet" or "feather".
+        filename: Download name of the file, without suffix.
+    """
+    f = to_arrow(rows, fieldnames, fmt=fmt)
+    return send_file(
+        f,
+        mimetype=ARROW_FORMATS[fmt],
+        as_attachment=True,
+        download_name=f"{filename}.{fmt}",
+        max_age=1,
+    )
+
+
+def send_xlsx(rows, fieldnames, filename: str):
+    """Sends flat datasets as an Excel workbook.
+
+    Args:
+        rows: Iterable of flat datasets.
+        fieldnames: The columns to include, in order.
+        filename: Download name of the file, without suffix.
+    """
+    f = to_xlsx(rows, fieldnames)
+    return send_file(
+        f,
+        mimetype=XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=f"{filename}.xlsx",
+        max_age=1,
+    )
+
+
+# export formats that require optional dependencies
+OPTIONAL_FORMATS = {"parquet": "pyarrow", "feather": "pyarrow", "xlsx": "openpyxl"}
+
+
+def format_unavailable(experiment, fmt: str):
+    """Returns a redirect to the export page, if exports in the format
+    *fmt* are not available, because its optional dependency is not
+    installed. Returns *None* otherwise.
+    """
+    module = OPTIONAL_FORMATS.get(fmt)
+    if module is None or importlib.util.find_spec(module) is not None:
+        return None
+
+    flash(
+        f"{fmt} exports are not available on this server, "
+        f"because {module} is not installed.",
+        "danger",
+    )
+    return redirect(
+        url_for(
+            "web_experiments.export",
+            username=experiment.author,
+            experiment_title=experiment.title,
+        )
     )
 
 
@@ -772,7 +1046,7 @@ def export(username, experiment_title):
 )
 @login_required
 def export_main_data(username, experiment_title, delim: str, versions: str):
-    experiment = WebExperiment.objects.get_or_404(  # pylint: disable=no-member
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
         title=experiment_title, author=username
     )
     if experiment.author != current_user.username:
@@ -797,34 +1071,65 @@ def export_main_data(username, experiment_title, delim: str, versions: str):
     versions = versions.split("$VERSIONSEP$")
     if "all" not in versions:
         f.update({"exp_version": {"$in": versions}})
+    session_filter(f)
+
+    # selected columns are fetched via projection, in the order given
+    columns = request.args.getlist("columns")
+    if columns:
+        fieldnames = columns
+        projection = column_projection(columns)
+    else:
+        fieldnames = FieldnameCatalog.fieldnames_for(
+            str(experiment.id), versions, dtype, db[col]
+        )
+        projection = None
+
+    def rows():
+        cursor = db[col].find(f, projection=projection)
+        for dataset in cursor:
+            dataset.setdefault("exp_data", {})
+            yield data_manager.DataManager.flatten(dataset)
 
-    cursor = db[col].find(f)
-    fieldnames = data_manager.DataManager.extract_ordered_fieldnames(cursor)
+    if delim in ARROW_FORMATS:
+        unavailable = format_unavailable(experiment, delim)
+        if unavailable:
+            return unavailable
 
-    # fresh cursor is needed, because previous one is exhausted
-    cursor = db[col].find(f)
-    data = [data_manager.DataManager.flatten(dataset) for dataset in cursor]
+        fn = f"{dtype}_{experiment.title}"
+        return send_columnar(rows(), fieldnames, delim, fn)
+
+    elif delim == "xlsx":
+        unavailable = format_unavailable(experiment, delim)
+        if unavailable:
+            return unavailable
+
+        return send_xlsx(rows(), fieldnames, f"{dtype}_{experiment.title}")
+
+    data = rows()
 
     if delim == "comma":
         delim = ","
     elif delim == "semicolon":
         delim = ";"
 
-    f = io.StringIO()
-    writer = csv.DictWriter(
-        f, fieldnames=fieldnames, delimiter=delim, extrasaction="ignore"
-    )
-    writer.writeheader()
-    writer.writerows(data)
-
+    chunks = csv_chunks(data, fieldnames, delimiter=delim)
     fn = f"{dtype}_{experiment.title}.csv"
-    return send_file(
-        make_str_bytes(f),
-        mimetype="text/csv",
-        as_attachment=True,
-        download_name=fn,
-        max_age=1,
-    )
+    return send_stream(chunks, fn, "text/csv")
+
+
+def flash_label_changes(codebook: Codebook):
+    """Warns about label changes between the last two datasets of a
+    codebook."""
+    for change in codebook.label_changes:
+        flash(
+            (
+                f"Codebook: {change['label']} of '{change['name']}' has changed from '{change['old']}' to '{change['new']}'. "
+                "This introduces inconsistencies into the codebook. "
+                "Do you have dynamic labels that do not match their elements' names? "
+                "To change a label, increase the experiment version."
+            ),
+            "warning",
+        )
 
 
 @web_experiments.route(
@@ -832,7 +1137,7 @@ def export_main_data(username, experiment_title, delim: str, versions: str):
 )
 @login_required
 def export_codebook_data(username, experiment_title, delim: str, version: str):
-    experiment = WebExperiment.objects.get_or_404(  # pylint: disable=no-member
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
         title=experiment_title, author=username
     )
     if experiment.author != current_user.username:
@@ -852,58 +1157,17 @@ def export_codebook_data(username, experiment_title, delim: str, version: str):
             )
         )
 
-    dtype_main = data_manager.DataManager.EXP_DATA
-    dtype_unlinked = data_manager.DataManager.UNLINKED_DATA
+    codebook = Codebook.get(
+        exp_id=str(experiment.id),
+        exp_version=version,
+        col=db[col],
+        col_unlinked=db[col_unlinked],
+        rebuild=request.args.get("rebuild") == "true",
+    )
 
-    f_main = {"exp_id": str(experiment.id), "type": dtype_main, "exp_version": version}
-    f_unlinked = {
-        "exp_id": str(experiment.id),
-        "type": dtype_unlinked,
-        "exp_version": version,
-    }
-
-    cursor_main = db[col].find(f_main)
-    cursor_unlinked = db[col_unlinked].find(f_unlinked)
-
-    # extract individual codebooks for each experimen session
-    cbdata_collection = []
-    for entry in cursor_main:
-        cb = data_manager.DataManager.extract_codebook_data(entry)
-        cbdata_collection.append(cb)
-    for entry in cursor_unlinked:
-        cb = data_manager.DataManager.extract_codebook_data(entry)
-        cbdata_collection.append(cb)
-
-    # combine them to a single dictionary, overwriting old values
-    # with newer ones
-    data = {}
-    n = len(cbdata_collection)
-    for i, entry in enumerate(cbdata_collection):
-        # check if all labels in the last two data sets match
-        if i == n - 1 and data:
-            for name, cb in entry.items():
-                for lab in [
-                    "label_top",
-                    "label_left",
-                    "label_right",
-                    "label_bottom",
-                    "placeholder",
-                ]:
-                    old = data.get(name, "")
-                    oldlab = old.get(lab, "") if old else ""
-                    newlab = cb.get(lab, "")
-                    if not oldlab == newlab:
-                        flash(
-                            (
-                                f"Codebook: {lab} of '{name}' has changed from '{oldlab}' to '{newlab}'. "
-                                "This introduces inconsistencies into the codebook. "
-                                "Do you have dynamic labels that do not match their elements' names? "
-                                "To change a label, increase the experiment version."
-                            ),
-                            "warning",
-                        )
-        data.update(entry)
+    flash_label_changes(codebook)
 
+    data = codebook.entries
     fieldnames = data_manager.DataManager.extract_fieldnames(data.values())
     fieldnames = data_manager.DataManager.sort_codebook_fieldnames(fieldnames)
 
@@ -934,7 +1198,7 @@ def export_codebook_data(username, experiment_title, delim: str, version: str):
 )
 @login_required
 def export_move_data(username, experiment_title, delim: str, versions: str):
-    experiment = WebExperiment.objects.get_or_404(  # pylint: disable=no-member
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
         title=experiment_title, author=username
     )
     if experiment.author != current_user.username:
@@ -959,34 +1223,44 @@ def export_move_data(username, experiment_title, delim: str, versions: str):
     versions = versions.split("$VERSIONSEP$")
     if "all" not in versions:
         f.update({"exp_version": {"$in": versions}})
-
-    cursor = db[col].find(f)
-    data = []
-    for sessiondata in cursor:
-        session_history = sessiondata.pop("exp_move_history", [])
-        data += session_history
-    fieldnames = data_manager.DataManager.extract_fieldnames(data)
+    session_filter(f)
+
+    # the move history is unwound on the server, so that only the
+    # individual move records are transferred
+    pipeline = [
+        {"$match": f},
+        {"$project": {"_id": False, "exp_move_history": True}},
+        {"$unwind": "$exp_move_history"},
+        {"$replaceRoot": {"newRoot": "$exp_move_history"}},
+    ]
+
+    def moves():
+        return db[col].aggregate(pipeline)
+
+    if delim in ARROW_FORMATS:
+        unavailable = format_unavailable(experiment, delim)
+        if unavailable:
+            return unavailable
+        # the columns are collected while the moves are written
+        fn = f"move_history_{experiment.title}"
+        return send_columnar(moves(), None, delim, fn)
+
+    fieldnames = data_manager.DataManager.extract_fieldnames(moves())
+    if delim == "xlsx":
+        unavailable = format_unavailable(experiment, delim)
+        if unavailable:
+            return unavailable
+
+        return send_xlsx(moves(), fieldnames, f"move_history_{experiment.title}")
 
     if delim == "comma":
         delim = ","
     elif delim == "semicolon":
         delim = ";"
 
-    f = io.StringIO()
-    writer = csv.DictWriter(
-        f, fieldnames=fieldnames, delimiter=delim, extrasaction="ignore"
-    )
-    writer.writeheader()
-    writer.writerows(data)
-
+    chunks = csv_chunks(moves(), fieldnames, delimiter=delim)
     fn = f"move_history_{experiment.title}.csv"
-    return send_file(
-        make_str_bytes(f),
-        mimetype="text/csv",
-        as_attachment=True,
-        download_name=fn,
-        max_age=1,
-    )
+    return send_stream(chunks, fn, "text/csv")
 
 
 @web_experiments.route(
@@ -994,7 +1268,7 @@ def export_move_data(username, experiment_title, delim: str, versions: str):
 )
 @login_required
 def export_unlinked_data(username, experiment_title, delim: str, versions: str):
-    experiment = WebExperiment.objects.get_or_404(  # pylint: disable=no-member
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
         title=experiment_title, author=username
     )
     if experiment.author != current_user.username:
@@ -1020,26 +1294,38 @@ def export_unlinked_data(username, experiment_title, delim: str, versions: str):
     if "all" not in versions:
         f.update({"exp_version": {"$in": versions}})
 
-    cursor = db[col].find(f)
-    data = [data_manager.DataManager.flatten(dataset) for dataset in cursor]
-    fieldnames = data_manager.DataManager.extract_fieldnames(data)
-
-    fern = create_fernet()
-    key = fern.decrypt(current_user.encryption_key)
-    data = data_manager.decrypt_recursively(data=data, key=key)
-
-    random.shuffle(data)
-
-    if delim == "json":
-        f = json.dumps(list(data), indent=4, sort_keys=True)
-        fn = f"unlinked_{experiment.title}.json"
-        return send_file(
-            make_str_bytes(f),
-            mimetype="application/json",
-            as_attachment=True,
-            download_name=fn,
-            max_age=1,
-        )
+    def flat_data():
+        cursor = db[col].find(f)
+        return (data_manager.DataManager.flatten(dataset) for dataset in cursor)
+
+    fieldnames = FieldnameCatalog.fieldnames_for(
+        str(experiment.id), versions, dtype, db[col]
+    )
+
+    # the shuffle breaks the link to the main data. It takes place before
+    # decryption, so that only encrypted values are spilled to disk.
+    buffer_size = current_app.config["EXPORT_SHUFFLE_BUFFER_SIZE"]
+    data = decrypt_documents(shuffled(flat_data(), buffer_size=buffer_size))
+
+    if delim in ARROW_FORMATS:
+        unavailable = format_unavailable(experiment, delim)
+        if unavailable:
+            return unavailable
+
+        fn = f"{dtype}_{experiment.title}"
+        return send_columnar(data, fieldnames, delim, fn)
+
+    elif delim == "xlsx":
+        unavailable = format_unavailable(experiment, delim)
+        if unavailable:
+            return unavailable
+
+        return send_xlsx(data, fieldnames, f"{dtype}_{experiment.title}")
+
+    elif delim in ["json", "ndjson"]:
+        chunks = json_chunks(data, ndjson=delim == "ndjson")
+        fn = f"unlinked_{experiment.title}.{delim}"
+        return send_stream(chunks, fn, JSON_MIMETYPES[delim])
 
     else:
         if delim == "comma":
@@ -1047,33 +1333,27 @@ def export_unlinked_data(username, experiment_title, delim: str, versions: str):
         elif delim == "semicolon":
             delim = ";"
 
-        f = io.StringIO()
-        writer = csv.DictWriter(
-            f, fieldnames=fieldnames, delimiter=delim, extrasaction="ignore"
-        )
-        writer.writeheader()
-        writer.writerows(data)
-
+        chunks = csv_chunks(data, fieldnames, delimiter=delim)
         fn = f"{dtype}_{experiment.title}.csv"
-        return send_file(
-            make_str_bytes(f),
-            mimetype="text/csv",
-            as_attachment=True,
-            download_name=fn,
-            max_age=1,
-        )
+        return send_stream(chunks, fn, "text/csv")
 
 
 @web_experiments.route(
-    "/<username>/<path:experiment_title>/export_full_data/<versions>"
+    "/<username>/<path:experiment_title>/export_full_data/<versions>",
+    defaults={"delim": "json"},
+)
+@web_experiments.route(
+    "/<username>/<path:experiment_title>/export_full_data/<delim>/<versions>"
 )
 @login_required
-def export_full_data(username, experiment_title, versions: str):
-    experiment = WebExperiment.objects.get_or_404(  # pylint: disable=no-member
+def export_full_data(username, experiment_title, delim: str, versions: str):
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
         title=experiment_title, author=username
     )
     if experiment.author != current_user.username:
         abort(403)
+    if delim not in JSON_MIMETYPES:
+        abort(404)
 
     dtype = data_manager.DataManager.EXP_DATA
 
@@ -1094,82 +1374,245 @@ def export_full_data(username, experiment_title, versions: str):
     versions = versions.split("$VERSIONSEP$")
     if "all" not in versions:
         f.update({"exp_version": {"$in": versions}})
+    session_filter(f)
 
     data = db[col].find(f)
 
-    f = json.dumps(list(data), indent=4, sort_keys=True)
-    fn = f"full_{experiment.title}.json"
-    return send_file(
-        make_str_bytes(f),
-        mimetype="application/json",
-        as_attachment=True,
-        download_name=fn,
-        max_age=1,
-    )
+    chunks = json_chunks(data, ndjson=delim == "ndjson")
+    fn = f"full_{experiment.title}.{delim}"
+    return send_stream(chunks, fn, JSON_MIMETYPES[delim])
 
 
 @web_experiments.route(
-    "/<username>/<path:experiment_title>/export_plugin_data/<versions>"
+    "/<username>/<path:experiment_title>/export_plugin_data/<versions>",
+    defaults={"delim": "json"},
+)
+@web_experiments.route(
+    "/<username>/<path:experiment_title>/export_plugin_data/<delim>/<versions>"
 )
 @login_required
-def export_plugin_data(username, experiment_title, versions: str):
-    experiment = WebExperiment.objects.get_or_404(  # pylint: disable=no-member
+def export_plugin_data(username, experiment_title, delim: str, versions: str):
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
         title=experiment_title, author=username
     )
     if experiment.author != current_user.username:
         abort(403)
+    if delim not in JSON_MIMETYPES:
+        abort(404)
+
+    plugin_query = session["plugin_data_query"]
 
-    query = session["plugin_data_query"]["query"]
+    # copied, so that the query stored in the session remains unchanged
+    query = copy.deepcopy(plugin_query["query"])
+    query.setdefault("filter", {})
 
     db = get_alfred_db()
     col = current_user.alfred_col_misc
 
-    if not db[col].find_one():
-        flash("No data found.", "info")
+    versions = versions.split("$VERSIONSEP$")
+    if "all" not in versions:
+        query["filter"].update({"exp_version": {"$in": versions}})
+
+    if not db[col].find_one(query["filter"], projection={"_id": True}):
+        flash("No data found for your search", "info")
         return redirect(
             url_for(
                 "web_experiments.export",
-                username=experiment.author,
                 experiment_title=experiment.title,
+                username=experiment.author,
             )
         )
 
-    versions = versions.split("$VERSIONSEP$")
-    if "all" not in versions:
-        query["filter"].update({"exp_version": {"$in": versions}})
+    def docs():
+        page_size = current_app.config["EXPORT_PAGE_SIZE"]
+        for doc in paginated_find(db[col], page_size=page_size, **query):
+            # turn ObjectID into string to make it json serializable
+            if "_id" in doc:
+                doc["_id"] = str(doc["_id"])
+            yield doc
 
-    data = db[col].find(**query)
+    data = docs()
 
-    if not data:
-        flash("No data found for your search", "info")
+    # decrypt if necessary. Decryption works on chunks of documents,
+    # so that the data is never held in memory as a whole.
+    if plugin_query.get("encrypted", False):
+        data = decrypt_documents(data)
+
+    chunks = json_chunks(data, ndjson=delim == "ndjson")
+
+    fn = f"{plugin_query['type']}.{delim}"
+    if request.args.get("background"):
+        return start_export_job(experiment, chunks, fn, JSON_MIMETYPES[delim])
+    return send_stream(chunks, fn, JSON_MIMETYPES[delim])
+
+
+def start_export_job(experiment, chunks, filename: str, mimetype: str):
+    """Starts writing an export to a file in a background thread and
+    redirects to the export page, where the file can be downloaded once
+    it is ready. The export is compressed according to the request, see
+    :func:`.compress`.
+
+    All arguments needed to produce *chunks* must be evaluated before,
+    because there is no request context in the background thread.
+    """
+    body, filename, mimetype = compress(chunks, filename, mimetype)
+
+    ExportJob.remove_expired()
+    job = ExportJob(
+        username=current_user.username,
+        exp_id=str(experiment.id),
+        download_name=filename,
+        mimetype=mimetype,
+    ).save()
+    app = current_app._get_current_object()
+    thread = threading.Thread(
+        target=run_export_job, args=(app, job.id, body), daemon=True
+    )
+    thread.start()
+
+    flash(
+        "Your export has been started. It will be available for download on this page.",
+        "info",
+    )
+    return redirect(
+        url_for(
+            "web_experiments.export",
+            username=experiment.author,
+            experiment_title=experiment.title,
+        )
+    )
+
+
+def run_export_job(app, job_id, chunks):
+    """Writes an export to the file of an :class:`.ExportJob`. Runs in
+    a background thread.
+    """
+    with app.app_context():
+        job = ExportJob.objects.get(id=job_id)
+        try:
+            job.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(job.path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except Exception as e:
+            molog = logging.getLogger("mortimer")
+            molog.exception(f"Export job {job_id} failed.")
+            job.fail(str(e))
+        else:
+            job.status = "done"
+            job.finished = datetime.now()
+            job.save()
+
+
+@web_experiments.route(
+    "/<username>/<path:experiment_title>/export_bundle/<delim>/<versions>"
+)
+@login_required
+def export_bundle(username, experiment_title, delim: str, versions: str):
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
+        title=experiment_title, author=username
+    )
+    if experiment.author != current_user.username:
+        abort(403)
+
+    db = get_alfred_db()
+    col = db[current_user.alfred_col]
+    col_unlinked = db[current_user.alfred_col_unlinked]
+
+    if not col.find_one():
+        flash("No data found.", "info")
         return redirect(
             url_for(
                 "web_experiments.export",
-                experiment_title=experiment.title,
                 username=experiment.author,
+                experiment_title=experiment.title,
             )
         )
 
-    dlist = list(data)
+    exp_id = str(experiment.id)
+    dtype_main = data_manager.DataManager.EXP_DATA
+    dtype_unlinked = data_manager.DataManager.UNLINKED_DATA
 
-    for doc in dlist:  # turn ObjectID into string to make it json serializable
-        doc["_id"] = str(doc["_id"])
+    versions = versions.split("$VERSIONSEP$")
+    f_main = {"exp_id": exp_id, "type": dtype_main}
+    f_unlinked = {"exp_id": exp_id, "type": dtype_unlinked}
+    if "all" not in versions:
+        f_main["exp_version"] = {"$in": versions}
+        f_unlinked["exp_version"] = {"$in": versions}
+    session_filter(f_main)
+
+    # unlinked codebooks and fieldnames are collected by the export,
+    # which reads all unlinked datasets anyway
+    if "all" in versions:
+        versions = sorted(col.distinct("exp_version", f_main), key=str)
+    codebooks = {}
+    for version in versions:
+        codebook = Codebook.get(exp_id, version, col, None)
+        flash_label_changes(codebook)
+        codebooks[version] = codebook.entries
 
-    # decrypt if necessary
-    if session["plugin_data_query"].get("encrypted", False):
-        fern = create_fernet()
-        key = fern.decrypt(current_user.encryption_key)
-        dlist = data_manager.decrypt_recursively(dlist, key=key)
+    if delim == "comma":
+        delim = ","
+    elif delim == "semicolon":
+        delim = ";"
+
+    # the key is fetched here, because there is no current user in a
+    # background job
+    key = create_fernet().decrypt(current_user.encryption_key)
+    buffer_size = current_app.config["EXPORT_SHUFFLE_BUFFER_SIZE"]
+
+    def shuffle_and_decrypt(rows):
+        return decrypt_documents(shuffled(rows, buffer_size=buffer_size), key=key)
+
+    bundle = ExportBundle(
+        title=experiment.title,
+        main_fieldnames=FieldnameCatalog.fieldnames_for(
+            exp_id, versions, dtype_main, col
+        ),
+        codebooks=codebooks,
+        unlinked_transform=shuffle_and_decrypt,
+        delimiter=delim,
+    )
+    chunks = bundle.chunks(col.find(f_main), col_unlinked.find(f_unlinked))
+    fn = f"data_{experiment.title}.zip"
+
+    if request.args.get("background"):
+        return start_export_job(experiment, chunks, fn, "application/zip")
+    return send_stream(chunks, fn, "application/zip")
+
+
+@web_experiments.route(
+    "/<username>/<path:experiment_title>/export_job/<job_id>", methods=["GET"]
+)
+@login_required
+def export_job(username, experiment_title, job_id):
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
+        title=experiment_title, author=username
+    )
+    if experiment.author != current_user.username:
+        abort(403)
 
-    f = json.dumps(dlist, indent=4, sort_keys=True)
+    job = ExportJob.objects.get_or_404(  # pylint: disable=no-member
+        id=job_id, exp_id=str(experiment.id)
+    )
+    if job.username != current_user.username:
+        abort(403)
+
+    if job.status != "done":
+        flash("This export is not available for download.", "warning")
+        return redirect(
+            url_for(
+                "web_experiments.export",
+                username=experiment.author,
+                experiment_title=experiment.title,
+            )
+        )
 
-    filename = session["plugin_data_query"]["type"]
-    fn = f"{filename}.json"
     return send_file(
-        make_str_bytes(f),
-        mimetype="application/json",
+        job.path,
+        mimetype=job.mimetype,
         as_attachment=True,
-        download_name=fn,
+        download_name=job.download_name,
         max_age=1,
     )
 
@@ -1177,7 +1620,7 @@ def export_plugin_data(username, experiment_title, versions: str):
 @web_experiments.route("/<username>/<path:experiment_title>/data", methods=["GET"])
 @login_required
 def data(username, experiment_title):
-    experiment = WebExperiment.objects.get_or_404(  # pylint: disable=no-member
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
         title=experiment_title, author=username
     )
     if experiment.author != current_user.username:
@@ -1185,8 +1628,7 @@ def data(username, experiment_title):
 
     db = get_user_collection()
 
-    results = db.count_documents({"exp_id": str(experiment.id)})
-    if results == 0:
+    if not db.find_one({"exp_id": str(experiment.id)}, projection={"_id": True}):
         flash("No data found for this experiment.", "warning")
         return redirect(
             url_for(
@@ -1196,21 +1638,167 @@ def data(username, experiment_title):
             )
         )
 
-    cur = db.find({"exp_id": str(experiment.id)}, limit=30)
-    fieldnames = data_manager.DataManager.extract_ordered_fieldnames(cur)
-    cur = db.find({"exp_id": str(experiment.id)}, limit=30)
-    data = [data_manager.DataManager.flatten(d) for d in cur]
-
-    # hotfix for performance-issues: show only the first fifty entries.
-    # TODO: Implement AJAX for DataTables display
-    flash("Showing only the first 30 rows.", "info")
+    fieldnames = FieldnameCatalog.fieldnames_for(
+        str(experiment.id), ["all"], data_manager.DataManager.EXP_DATA, db
+    )
 
     return render_template(
         "data.html",
         experiment=experiment,
         author=username,
-        data=data,
         fieldnames=fieldnames,
+        sortable=[i for i, name in enumerate(fieldnames) if name in SORTABLE_FIELDS],
+    )
+
+
+# fields that the data table can be sorted by. Each one has an index on
+# (exp_id, type, field, _id) in User.ALFRED_INDEXES, so that pages are
+# read in index order, and values of the same type in all datasets, which
+# is required for keyset pagination. Datasets may lack the field.
+SORTABLE_FIELDS = [
+    "exp_start_time",
+    "exp_save_time",
+    "exp_session_id",
+]
+
+# cached total counts and known page boundaries of the data table.
+# Both are only valid as long as no dataset is saved.
+_table_counts = StampedCache(maxsize=256, ttl=60)
+_table_pages = StampedCache(maxsize=256, ttl=600)
+
+
+def table_cell(value):
+    if value is None:
+        return ""
+    elif isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def keyset_filter(field: str, value, last_id, direction: int) -> list:
+    """Returns the *$or* clauses that select all datasets after the one
+    with *value* and *last_id*, sorted by *field* and *_id* in
+    *direction*.
+
+    MongoDB sorts null values and missing fields before all other
+    values, and comparison operators never match them, so they need
+    clauses of their own.
+    """
+    op = "$gt" if direction == 1 else "$lt"
+    if value is None:
+        clauses = [{field: None, "_id": {op: last_id}}]
+        if direction == 1:
+            clauses.append({field: {"$ne": None}})
+        return clauses
+
+    clauses = [{field: {op: value}}, {field: value, "_id": {op: last_id}}]
+    if direction == -1:
+        clauses.append({field: None})
+    return clauses
+
+
+@web_experiments.route(
+    "/<username>/<path:experiment_title>/data/table", methods=["POST"]
+)
+@login_required
+def data_table(username, experiment_title):
+    """Serves datasets to the data preview table, implementing the
+    server-side processing protocol of DataTables.
+
+    Pages are fetched with keyset pagination: The sort value and *_id*
+    of the last dataset of every served page are cached, so that the
+    next page starts right after it, instead of skipping all previous
+    datasets. Only pages that are requested out of order are fetched
+    with *skip*.
+
+    The parameters are sent as a form, because DataTables sends several
+    parameters per column, which exceeds the URL length limits of web
+    servers for typical experiments. The table shows all fieldnames, so
+    all fields are fetched except for the move history and plugin
+    queries.
+    """
+    experiment = WebExperiment.light.get_or_404(  # pylint: disable=no-member
+        title=experiment_title, author=username
+    )
+    if experiment.author != current_user.username:
+        abort(403)
+
+    db = get_user_collection()
+    exp_id = str(experiment.id)
+    f = {"exp_id": exp_id, "type": data_manager.DataManager.EXP_DATA}
+
+    params = request.form
+    try:
+        draw = int(params.get("draw", 0))
+        start = max(int(params.get("start", 0)), 0)
+        length = int(params.get("length", 50))
+        order_column = int(params.get("order[0][column]", -1))
+    except ValueError:
+        abort(400)
+    length = min(max(length, 1), current_app.config["DATA_TABLE_MAX_LENGTH"])
+
+    columns = []
+    while f"columns[{len(columns)}][name]" in params:
+        columns.append(params[f"columns[{len(columns)}][name]"])
+
+    field = "_id"
+    if 0 <= order_column < len(columns) and columns[order_column] in SORTABLE_FIELDS:
+        field = columns[order_column]
+    direction = -1 if params.get("order[0][dir]") == "desc" else 1
+
+    # cached values are valid until the next dataset is saved
+    newest = db.find_one(
+        f,
+        projection={"_id": False, "exp_save_time": True},
+        sort=[("exp_save_time", -1)],
+    )
+    stamp = newest.get("exp_save_time") if newest else None
+
+    total = _table_counts.get(exp_id, stamp)
+    if total is None:
+        total = db.count_documents(f)
+        _table_counts.set(exp_id, total, stamp=stamp)
+
+    page_key = (exp_id, field, direction, length)
+    boundaries = _table_pages.get(page_key, stamp)
+    if boundaries is None:
+        boundaries = {}
+        _table_pages.set(page_key, boundaries, stamp=stamp)
+
+    sort = (
+        [(field, direction)]
+        if field == "_id"
+        else [(field, direction), ("_id", direction)]
+    )
+    projection = FieldnameCatalog.PROJECTION
+
+    query = dict(f)
+    skip = 0
+    boundary = boundaries.get(start)
+    if start > 0 and boundary is not None:
+        value, last_id = boundary
+        op = "$gt" if direction == 1 else "$lt"
+        if field == "_id":
+            query["_id"] = {op: last_id}
+        else:
+            query["$or"] = keyset_filter(field, value, last_id, direction)
+    else:
+        skip = start
+
+    docs = list(db.find(query, projection, sort=sort, skip=skip, limit=length))
+
+    if docs:
+        last = docs[-1]
+        boundaries[start + len(docs)] = (last.get(field), last["_id"])
+
+    rows = []
+    for doc in docs:
+        doc.setdefault("exp_data", {})
+        flat = data_manager.DataManager.flatten(doc)
+        rows.append([table_cell(flat.get(name)) for name in columns])
+
+    return jsonify(
+        {"draw": draw, "recordsTotal": total, "recordsFiltered": total, "data": rows}
     )
 
 
@@ -1228,7 +1816,7 @@ def de_activate_experiment(username, experiment_title):
         abort(403)
 
     if not experiment.active:
-        if not experiment.script:
+        if not experiment.has_script:
             flash(
                 "You need to upload a script.py before you can activate your experiment.",
                 "warning",
@@ -1315,7 +1903,7 @@ def experiment_config(username, experiment_title):
 @login_required
 def experiment_log(username, experiment_title, end, start):
     # pylint: disable=no-member
-    exp = WebExperiment.objects.get_or_404(title=experiment_title, author=username)
+    exp = WebExperiment.light.get_or_404(title=experiment_title, author=username)
 
     if exp.author != current_user.username:
         abort(403)
@@ -1497,60 +2085,175 @@ def update_users():
     return render_template("home.html", id=None)
 
 
+@web_experiments.route("/<username>/<path:experiment_title>/query_report")
+@login_required
+def query_report(username, experiment_title):
+    """Explains the queries that the dashboard, data preview and exports
+    run on an experiment's datasets and flags collection scans.
+    """
+    if current_user.role != "admin":
+        abort(403)
+
+    # pylint: disable=no-member
+    experiment = WebExperiment.light.get_or_404(title=experiment_title, author=username)
+    user = User.objects.get_or_404(username=username)
+
+    alfred_db = get_alfred_db()
+    col = alfred_db[user.alfred_col]
+    col_unlinked = alfred_db[user.alfred_col_unlinked]
+
+    exp_id = str(experiment.id)
+    main = {"exp_id": exp_id, "type": data_manager.DataManager.EXP_DATA}
+    unlinked = {"exp_id": exp_id, "type": data_manager.DataManager.UNLINKED_DATA}
+    version = {"exp_version": {"$in": [experiment.version]}}
+    stats = ExperimentStatistics.objects(exp_id=exp_id).first()
+    stats = stats or ExperimentStatistics(exp_id=exp_id)
+    now = datetime.now().timestamp()
+
+    queries = [
+        ("Dashboard statistics", col, {"filter": stats.new_datasets_filter()}),
+        (
+            "Dashboard statistics, rebuild",
+            col,
+            {"filter": ExperimentStatistics(exp_id=exp_id).new_datasets_filter()},
+        ),
+        (
+            "Newest dataset",
+            col,
+            {"filter": main, "sort": [("exp_save_time", -1)]},
+        ),
+        ("Plugin data queries", col, {"pipeline": plugin_queries_pipeline(exp_id)}),
+        ("Main data export", col, {"filter": {**main, **version}}),
+        (
+            "Main data export, finished sessions",
+            col,
+            {"filter": {**main, "exp_finished": True, "exp_start_time": {"$gte": 0}}},
+        ),
+        (
+            "Codebook and fieldname updates",
+            col,
+            {
+                "filter": {**main, **version, "exp_save_time": {"$gt": now}},
+                "sort": [("exp_save_time", 1)],
+            },
+        ),
+        ("Unlinked data export", col_unlinked, {"filter": {**unlinked, **version}}),
+        (
+            "Unlinked codebook and fieldname updates",
+            col_unlinked,
+            {
+                "filter": {**unlinked, **version, "_id": {"$gt": ObjectId()}},
+                "sort": [("_id", 1)],
+            },
+        ),
+    ]
+
+    report = []
+    for title, c, query in queries:
+        try:
+            explanation = explain_query(c, **query)
+        except pymongo.errors.OperationFailure as e:
+            explanation = {"error": str(e)}
+        report.append({"title": title, "collection": c.name, **explanation})
+
+    return render_template(
+        "query_report.html",
+        experiment=experiment,
+        report=report,
+        missing_indexes=user.missing_indexes(),
+    )
+
+
 @web_experiments.route("/participation", methods=["POST", "GET"])
 def participation():
     alias = request.values.get("alias")
     exp_id = request.values.get("exp_id")
     exp_version = request.values.get("exp_version", None)
 
-    if not alias and not exp_id:
+    if not alias or not exp_id:
         abort(400)
 
-    alias = hashlib.sha224(alias.encode()).hexdigest()
-
-    # handle request of participation
-    if request.method == "GET":
-        participant = Participant.objects(alias=alias).first()
+    alias = Participant.hash_alias(alias)
 
-        if not participant or exp_id not in participant.experiments:
-            return make_response("false", 200)
+    try:
+        # handle request of participation
+        if request.method == "GET":
+            participated = Participant.participated(alias, exp_id, exp_version)
+            return make_response("true" if participated else "false", 200)
 
-        elif exp_id in participant.experiments:
+        # handle input of new data
+        elif request.method == "POST":
             if not exp_version:
-                return make_response("true", 200)
+                return abort(400)
 
-            elif exp_version in participant.experiments[exp_id]["versions"]:
-                return make_response("true", 200)
+            if Participant.register(alias, exp_id, exp_version):
+                return make_response("success", 201)
+            return make_response("already registered", 200)
+    except ValueError:
+        abort(400)
 
-            else:
-                return make_response("false", 200)
 
-    # handle input of new data
-    elif request.method == "POST":
-        if not exp_version:
-            return abort(400)
+@web_experiments.route("/participation/batch", methods=["POST"])
+def participation_batch():
+    """Checks the participation of one or more aliases in several
+    experiments with a single query.
 
-        participant = Participant.objects(alias=alias).first()
+    Expects a JSON object with either *alias* (string) or *aliases*
+    (list of strings), and *experiments*, a list of objects with an
+    *exp_id* and an optional *exp_version*. Responds with a JSON object
+    whose *results* list holds one entry per alias and experiment, in
+    the order of the request, with the additional key *participated*.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
 
-        if not participant:
-            participant = Participant(alias=alias)
+    aliases = data.get("aliases", [data["alias"]] if "alias" in data else [])
+    experiments = data.get("experiments")
+    if not isinstance(aliases, list) or not isinstance(experiments, list):
+        abort(400)
+    if not aliases or not experiments:
+        abort(400)
+    max_size = current_app.config["PARTICIPATION_BATCH_SIZE"]
+    if len(aliases) * len(experiments) > max_size:
+        abort(413)
 
-        if exp_id in participant.experiments:
-            if exp_version in participant.experiments[exp_id]["versions"]:
-                return make_response("already registered", 200)
+    if not all(isinstance(alias, str) for alias in aliases):
+        abort(400)
+    for exp in experiments:
+        if not isinstance(exp, dict) or not isinstance(exp.get("exp_id"), str):
+            abort(400)
+        exp_version = exp.get("exp_version")
+        if exp_version is not None and not isinstance(exp_version, str):
+            abort(400)
 
-            else:  # add version to participant
-                participant.experiments[exp_id]["versions"].append(exp_version)
-                participant.save()
-                return make_response("success"), 201
+    try:
+        hashed = {alias: Participant.hash_alias(alias) for alias in aliases}
+        exp_ids = {exp["exp_id"] for exp in experiments}
+        participations = Participant.participations(hashed.values(), exp_ids)
+    except ValueError:
+        abort(400)
 
-        else:  # first entry for participant
-            participant.experiments[exp_id] = {}
-            participant.experiments[exp_id]["versions"] = (
-                [exp_version] if exp_version is not None else []
+    results = []
+    for alias in aliases:
+        participation = participations.get(hashed[alias], {})
+        for exp in experiments:
+            exp_id = exp["exp_id"]
+            exp_version = exp.get("exp_version")
+            if exp_version:
+                participated = exp_version in participation.get(exp_id, [])
+            else:
+                participated = exp_id in participation
+            results.append(
+                {
+                    "alias": alias,
+                    "exp_id": exp_id,
+                    "exp_version": exp_version,
+                    "participated": participated,
+                }
             )
-            participant.save()
-            return make_response("success", 201)
+
+    return jsonify({"results": results})
 
 
 @web_experiments.route(
@@ -1559,7 +2262,7 @@ def participation():
 @login_required
 def update_urlparam(username, experiment_title):
     # pylint: disable=no-member
-    exp = WebExperiment.objects.get_or_404(title=experiment_title, author=username)
+    exp = WebExperiment.light.get_or_404(title=experiment_title, author=username)
 
     if exp.author != current_user.username:
         abort(403)
@@ -0,0 +1,97 @@
+import pytest
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """A mortimer app backed by an in-memory database."""
+    pytest.importorskip("alfred3")
+    pytest.importorskip("mongomock")
+    from cryptography.fernet import Fernet
+
+    from mortimer import create_app
+
+    instance = tmp_path_factory.mktemp("instance")
+    (instance / "mortimer.conf").write_text(
+        f"SECRET_KEY = {Fernet.generate_key().decode()!r}\n"
+        "import mongomock\n"
+        "MONGODB_SETTINGS = {'host': 'localhost', 'db': 'mortimer',"
+        " 'mongo_client_class': mongomock.MongoClient}\n"
+        "WTF_CSRF_ENABLED = False\n"
+        "TESTING = True\n"
+    )
+    return create_app(
+        instance_path=str(instance), logfile=str(instance / "mortimer.log")
+    )
+
+
+@pytest.fixture
+def database(app):
+    """Empties the mortimer database after the test."""
+    from mongoengine.connection import get_db
+
+    yield
+    with app.app_context():
+        mortimer_db = get_db()
+        for name in mortimer_db.list_collection_names():
+            mortimer_db.drop_collection(name)
+
+
+@pytest.fixture
+def app_context(app, database):
+    """Pushes an app context for model tests. Route tests must not use
+    it, because requests would share its *g*, including the logged in
+    user."""
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def alfred_db(monkeypatch):
+    """An empty alfred database, used by all routes."""
+    import mongomock
+
+    import mortimer.utils
+    import mortimer.web_experiments.routes
+
+    alfred = mongomock.MongoClient()["alfred"]
+    monkeypatch.setattr(mortimer.utils, "get_alfred_db", lambda: alfred)
+    monkeypatch.setattr(
+        mortimer.web_experiments.routes, "get_alfred_db", lambda: alfred
+    )
+    return alfred
+
+
+@pytest.fixture
+def user(app, database, alfred_db):
+    """An admin user with an experiment titled "exp"."""
+    from cryptography.fernet import Fernet
+
+    from mortimer.models import User, WebExperiment
+    from mortimer.utils import create_fernet
+
+    with app.app_context():
+        user = User(
+            username="tester",
+            email="tester@example.com",
+            password="x",
+            encryption_key=create_fernet().encrypt(Fernet.generate_key()),
+            alfred_col="alfred",
+            alfred_col_unlinked="unlinked",
+            alfred_col_misc="misc",
+            role="admin",
+        )
+        user.save()
+        WebExperiment(
+            title="exp", author=user.username, author_id=user.id, version="1.0"
+        ).save()
+    return user
+
+
+@pytest.fixture
+def client(app, user):
+    """A test client, logged in as *user*."""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user.id)
+        session["_fresh"] = True
+    return client
@@ -0,0 +1,339 @@
+import pytest
+
+import mortimer.export as export
+
+
+class TestColumnarExport:
+    rows = [
+        {"a": 1, "b": "x", "c": True, "d": {"nested": 1}},
+        {"a": 2.5, "b": 3, "c": None},
+    ]
+
+    def test_arrow_schema(self):
+        pa = pytest.importorskip("pyarrow")
+        schema = export.arrow_schema(self.rows, ["a", "b", "c", "d", "e"])
+
+        assert schema.field("a").type == pa.float64()
+        assert schema.field("b").type == pa.string()
+        assert schema.field("c").type == pa.bool_()
+        assert schema.field("d").type == pa.string()
+        assert schema.field("e").type == pa.string()
+
+    def test_to_parquet(self):
+        pq = pytest.importorskip("pyarrow.parquet")
+        f = export.to_arrow(iter(self.rows * 3), ["a", "b", "c"], batch_size=4)
+
+        table = pq.read_table(f)
+        assert table.num_rows == 6
+        assert table.column("b").to_pylist()[:2] == ["x", "3"]
+
+    @pytest.mark.parametrize("fmt", ["parquet", "feather"])
+    def test_widened_columns(self, fmt):
+        pa = pytest.importorskip("pyarrow")
+        pq = pytest.importorskip("pyarrow.parquet")
+        rows = [{"a": 1, "b": True}] * 3 + [{"a": 2.5, "b": "x", "c": 1}]
+        f = export.to_arrow(iter(rows), fmt=fmt, batch_size=2)
+
+        if fmt == "parquet":
+            table = pq.read_table(f)
+        else:
+            table = pa.ipc.open_file(f).read_all()
+        assert table.schema.field("a").type == pa.float64()
+        assert table.column("a").to_pylist() == [1.0, 1.0, 1.0, 2.5]
+        assert table.column("b").to_pylist() == ["True", "True", "True", "x"]
+        assert table.column("c").to_pylist() == [None, None, None, "1"]
+
+
+class TestStreamedExport:
+    rows = [{"a": i, "b": "line\nbreak"} for i in range(25)]
+
+    def test_csv_chunks(self):
+        chunks = list(export.csv_chunks(self.rows, ["a", "b"], chunk_size=10))
+
+        assert len(chunks) == 3
+        assert chunks[0].startswith("a,b\r\n0,")
+
+    def test_gzip_chunks(self):
+        import gzip
+
+        csv = "".join(export.csv_chunks(self.rows, ["a", "b"]))
+        compressed = b"".join(
+            export.gzip_chunks(export.csv_chunks(self.rows, ["a", "b"]))
+        )
+
+        assert gzip.decompress(compressed).decode() == csv
+
+    def test_zip_chunks(self):
+        import io
+        import zipfile
+
+        members = [("a.csv", export.csv_chunks(self.rows, ["a"])), ("b.json", ["[]"])]
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(export.zip_chunks(members))))
+
+        assert archive.namelist() == ["a.csv", "b.json"]
+        assert archive.read("b.json") == b"[]"
+
+
+class TestParallelDecryption:
+    def test_decrypt_parallel(self):
+        pytest.importorskip("alfred3")
+        from cryptography.fernet import Fernet
+
+        key = Fernet.generate_key()
+        f = Fernet(key)
+        docs = [{"i": i, "v": f.encrypt(str(i).encode()).decode()} for i in range(50)]
+
+        decrypted = list(export.decrypt_parallel(docs, key, processes=2, chunk_size=7))
+
+        assert decrypted == [{"i": i, "v": str(i)} for i in range(50)]
+
+    def test_pool_is_shared(self):
+        pytest.importorskip("alfred3")
+        from cryptography.fernet import Fernet
+
+        for _ in range(2):
+            key = Fernet.generate_key()
+            docs = [Fernet(key).encrypt(str(i).encode()).decode() for i in range(20)]
+            decrypted = export.decrypt_parallel(docs, key, processes=2, chunk_size=5)
+            assert list(decrypted) == [str(i) for i in range(20)]
+
+        assert len(export._decryption_pools) == 1
+
+
+class TestStreamedJSON:
+    def test_json_chunks_matches_json_dumps(self):
+        import json
+
+        docs = [{"b": [1, 2], "a": "x\ny"}, {"c": None}]
+        out = "".join(export.json_chunks(docs))
+
+        assert out == json.dumps(docs, indent=4, sort_keys=True)
+        assert "".join(export.json_chunks([])) == "[]"
+
+    def test_json_chunks_bson_types(self):
+        from datetime import datetime
+
+        from bson import ObjectId
+
+        oid = ObjectId()
+        docs = [{"_id": oid, "time": datetime(2021, 5, 1, 12, 30)}]
+        out = "".join(export.json_chunks(docs, ndjson=True))
+
+        assert out == f'{{"_id": "{oid}", "time": "2021-05-01T12:30:00"}}\n'
+
+
+class TestColumnProjection:
+    def test_column_projection(self):
+        projection = export.column_projection(
+            ["exp_version", "mc_c1", "additional_data_x"]
+        )
+
+        assert projection == {
+            "_id": False,
+            "exp_version": True,
+            "exp_data.exp.value": True,
+            "exp_data.exp_version.value": True,
+            "mc_c1": True,
+            "exp_data.mc.value": True,
+            "exp_data.mc_c1.value": True,
+            "additional_data": True,
+        }
+
+    def test_column_projection_path_collision(self):
+        projection = export.column_projection(["exp_data", "exp_data_x", "a"])
+
+        assert projection == {
+            "_id": False,
+            "exp_data": True,
+            "exp_data_x": True,
+            "a": True,
+        }
+
+        mongomock = pytest.importorskip("mongomock")
+        col = mongomock.MongoClient()["alfred"]["col"]
+        col.insert_one({"exp_data": {"a": {"value": 1}}, "exp_data_x": 2})
+        assert col.find_one({}, projection)["exp_data"] == {"a": {"value": 1}}
+
+
+class TestShuffle:
+    def test_shuffled_is_permutation(self):
+        items = [{"i": i} for i in range(1000)]
+        out = list(export.shuffled(iter(items), buffer_size=64))
+
+        assert sorted(out, key=lambda d: d["i"]) == items
+        assert out != items
+
+    def test_shuffled_in_memory(self):
+        assert sorted(export.shuffled(range(10), buffer_size=100)) == list(range(10))
+        assert list(export.shuffled([])) == []
+
+
+class TestExportBundle:
+    def dataset(self, i, label="Q"):
+        return {
+            "exp_id": "x",
+            "type": "exp_data",
+            "exp_version": "1.0",
+            "exp_save_time": 1000.0 + i,
+            "exp_title": "exp",
+            "exp_author": "me",
+            "alfred_version": "3",
+            "exp_data": {"q": {"name": "q", "value": i, "label_top": label}},
+            "exp_move_history": [{"tag": f"p{i}"}],
+        }
+
+    def members(self, bundle, main, unlinked):
+        return {fn: "".join(chunks) for fn, chunks in bundle.members(main, unlinked)}
+
+    def test_members(self):
+        pytest.importorskip("alfred3")
+        bundle = export.ExportBundle(
+            "exp",
+            main_fieldnames=["q"],
+            unlinked_fieldnames=["u"],
+            codebooks={"1.0": {"q": {"name": "q", "label_top": "Q"}}},
+        )
+        main = (self.dataset(i) for i in range(3))
+        members = self.members(bundle, main, [{"exp_data": {}, "u": 1}])
+
+        assert members["exp_data_exp.csv"] == "q\r\n0\r\n1\r\n2\r\n"
+        assert members["move_history_exp.csv"] == "tag\r\np0\r\np1\r\np2\r\n"
+        assert members["unlinked_exp.csv"] == "u\r\n1\r\n"
+        assert "label_top" in members["codebook_exp_1.0.csv"]
+
+    def test_collected_unlinked(self):
+        pytest.importorskip("alfred3")
+        read = []
+
+        def unlinked():
+            for i in range(3):
+                read.append(i)
+                dataset = self.dataset(i)
+                dataset["type"] = "unlinked"
+                dataset["exp_data"][f"u{i}"] = {"name": f"u{i}", "value": i}
+                yield dataset
+
+        bundle = export.ExportBundle(
+            "exp",
+            main_fieldnames=["q"],
+            codebooks={"1.0": {"q": {"name": "q", "label_top": "Q"}}},
+            unlinked_transform=export.shuffled,
+        )
+        members = self.members(bundle, [], unlinked())
+
+        assert read == [0, 1, 2]
+        header = members["unlinked_exp.csv"].splitlines()[0].split(",")
+        assert {"u0", "u1", "u2"} <= set(header)
+        for name in ["q", "u0", "u1", "u2"]:
+            assert f",{name}," in members["codebook_exp_1.0.csv"]
+
+    def test_codebook_label_change(self, app_context, alfred_db):
+        from mortimer.models import Codebook
+
+        col, col_unlinked = alfred_db["alfred"], alfred_db["unlinked"]
+        col.insert_many([self.dataset(0, "Old"), self.dataset(1, "New")])
+        codebook = Codebook.get("x", "1.0", col, col_unlinked)
+        assert len(codebook.label_changes) == 1
+
+        bundle = export.ExportBundle(
+            "exp",
+            main_fieldnames=["q"],
+            unlinked_fieldnames=[],
+            codebooks={"1.0": codebook.entries},
+        )
+        members = self.members(bundle, col.find(), [])
+        assert "New" in members["codebook_exp_1.0.csv"]
+        assert "Old" not in members["codebook_exp_1.0.csv"]
+
+
+class TestHeader:
+    docs = [
+        {
+            "tag": "root",
+            "_id": 1,
+            "a10": 1,
+            "a2": 2,
+            "subtree_data": [{"tag": "page", "x": 3}, {}],
+            "additional_data": {"k": 4},
+        },
+        {"tag": "root", "_id": 2, "b": 5},
+    ]
+
+    def test_cursor_to_rows(self):
+        rows = export.cursor_to_rows(self.docs, none_value="")
+
+        assert rows == [
+            ["a2", "a10", "b", "page.x", "additional_data.k"],
+            [2, 1, "", 3, 4],
+            ["", "", 5, "", ""],
+        ]
+
+    def test_frozen(self):
+        h = export.Header(*self.docs)
+        h.getDataFromDoc(self.docs[0])
+
+        with pytest.raises(RuntimeError):
+            h.addDoc({"tag": "root", "c": 1})
+
+    def test_str(self):
+        h = export.Header(*self.docs)
+        assert str(h.children["page"]) == "root.page"
+
+
+class TestStreamedLegacyExport:
+    docs = [
+        {"tag": "root", "a": "line\nbreak", "b": 1},
+        {"tag": "root", "c": None},
+    ]
+
+    def test_iter_json_matches_json_util(self):
+        from bson import ObjectId, json_util
+
+        docs = [{"_id": ObjectId(), "a": [1, {"b": "x"}], "e": {}} for _ in range(3)]
+        out = b"".join(export.iter_json(docs))
+
+        assert out.decode() == json_util.dumps(docs, indent=4)
+        assert "".join(export.iter_json([], encoding=None)) == "[]"
+
+    def test_iter_json_shuffles_before_decryption(self):
+        class Decryptor:
+            def __init__(self):
+                self.pending = 0
+
+            def decrypt(self, doc):
+                self.pending -= 1
+                return {**doc, "decrypted": True}
+
+        def docs():
+            for i in range(20):
+                decryptor.pending += 1
+                yield {"i": i}
+
+        decryptor = Decryptor()
+        chunks = export.iter_json(
+            docs(), shuffle=True, decryptor=decryptor, buffer_size=5
+        )
+        next(chunks)
+        # all documents were shuffled before the first one was decrypted
+        assert decryptor.pending == 19
+
+    def test_iter_excel_csv_removes_linebreaks(self):
+        out = b"".join(export.iter_excel_csv(iter(self.docs), none_value=""))
+        assert out == b"a;b;c\r\nlinebreak;1;\r\n;;\r\n"
+
+    def test_iter_csv_chunks(self):
+        chunks = list(export.iter_csv(self.docs * 5, chunk_size=4))
+        assert len(chunks) == 3
+
+
+class TestXlsxExport:
+    def test_to_xlsx_splits_sheets(self):
+        openpyxl = pytest.importorskip("openpyxl")
+        rows = ({"a": i, "b": f"x\x01{i}"} for i in range(5))
+        f = export.to_xlsx(rows, ["a", "b"], max_rows=3)
+
+        wb = openpyxl.load_workbook(f)
+        assert wb.sheetnames == ["data", "data (2)", "data (3)"]
+
+        values = [[c.value for c in row] for row in wb["data"].iter_rows()]
+        assert values == [["a", "b"], [0, "x0"], [1, "x1"]]
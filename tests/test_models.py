@@ -0,0 +1,330 @@
+import time
+
+import pytest
+
+pytest.importorskip("alfred3")
+
+from alfred3.data_manager import DataManager  # noqa: E402
+
+from mortimer.models import (  # noqa: E402
+    Codebook,
+    ExperimentStatistics,
+    FieldnameCatalog,
+    Participant,
+    User,
+    WebExperiment,
+    load_user,
+)
+from mortimer.utils import (  # noqa: E402
+    load_script,
+    script_hash,
+    script_store_path,
+    store_script,
+)
+
+
+class TestUserCache:
+    def test_cached(self, app_context, user, monkeypatch):
+        user_id = str(user.id)
+        first = load_user(user_id)
+        User.objects(id=user.id).update(role="user")  # bypasses save()
+
+        second = load_user(user_id)
+        assert second.role == "admin"
+        assert second is not first
+
+        ttl = app_context.config["USER_CACHE_TTL"]
+        monotonic = time.monotonic
+        monkeypatch.setattr(time, "monotonic", lambda: monotonic() + ttl + 1)
+        assert load_user(user_id).role == "user"
+
+    def test_invalidated_on_save(self, app_context, user):
+        user_id = str(user.id)
+        cached = load_user(user_id)
+        cached.role = "user"
+        cached.save()
+        assert load_user(user_id).role == "user"
+
+    def test_invalidated_on_delete(self, app_context, user):
+        user_id = str(user.id)
+        load_user(user_id).delete()
+        assert load_user(user_id) is None
+
+
+class TestParticipant:
+    def test_register(self, app_context):
+        assert Participant.register("alias", "e1", "1.0") is True
+        assert Participant.register("alias", "e1", "1.0") is False
+        assert Participant.register("alias", "e1", "2.0") is True
+        assert Participant.register("alias", "e2", "1.0") is True
+        assert Participant.objects.count() == 1
+
+        assert Participant.participated("alias", "e1")
+        assert Participant.participated("alias", "e1", "2.0")
+        assert not Participant.participated("alias", "e1", "3.0")
+        assert not Participant.participated("other", "e1")
+        assert Participant.participations(["alias", "other"], ["e1"]) == {
+            "alias": {"e1": ["1.0", "2.0"]}
+        }
+
+    def test_invalid_experiment_id(self, app_context):
+        for exp_id in ["", "a.b", "$a"]:
+            with pytest.raises(ValueError):
+                Participant.register("alias", exp_id, "1.0")
+
+
+class TestScriptStore:
+    def experiment(self, **kwargs):
+        exp = WebExperiment(title="exp", author="tester", version="1.0", **kwargs)
+        exp.save()
+        return exp
+
+    def test_store_and_load(self, app_context):
+        digest = store_script("print('a')")
+        assert digest == script_hash("print('a')")
+        assert store_script("print('a')") == digest
+        assert load_script(digest) == "print('a')"
+
+    def test_history(self, app_context):
+        exp = WebExperiment(title="exp", author="tester", version="1.0")
+        exp.script = "a = 1"
+        exp.save()
+
+        exp = WebExperiment.light.get(id=exp.id)
+        exp.script = "a = 2"
+        exp.save()
+        exp = WebExperiment.light.get(id=exp.id)
+        exp.script = "a = 2"
+        exp.save()
+
+        exp = WebExperiment.objects.get(id=exp.id)
+        assert exp.script == "a = 2"
+        assert [e["hash"] for e in exp.script_history] == [
+            script_hash("a = 1"),
+            script_hash("a = 2"),
+        ]
+
+    def test_legacy_migration(self, app_context):
+        exp = self.experiment(legacy_script="a = 1")
+        assert WebExperiment.objects.get(id=exp.id).script == "a = 1"
+
+        exp = WebExperiment.light.get(id=exp.id)
+        exp.script = "a = 2"
+        exp.save()
+
+        exp = WebExperiment.objects.get(id=exp.id)
+        assert exp.legacy_script is None
+        assert exp.script == "a = 2"
+        assert len(exp.script_history) == 1
+
+    def test_hash_written_without_save(self, app_context):
+        exp = self.experiment(legacy_script="a = 1")
+        WebExperiment.light.get(id=exp.id).script = "a = 3"
+
+        exp = WebExperiment.objects.get(id=exp.id)
+        assert exp.has_script
+        assert exp.script == "a = 3"
+
+    def test_missing_store_file(self, app_context, tmp_path):
+        script_file = tmp_path / "script.py"
+        script_file.write_text("a = 4", encoding="utf-8")
+        exp = self.experiment(script_fullpath=str(script_file))
+        exp.script = "a = 4"
+        exp.save()
+
+        script_store_path(exp.script_hash).unlink()
+        assert exp.script == "a = 4"
+        assert script_store_path(exp.script_hash).exists()
+
+        script_store_path(exp.script_hash).unlink()
+        script_file.unlink()
+        assert exp.script is None
+
+
+class TestFieldnameCatalog:
+    datasets = [
+        {
+            "_id": 1,
+            "type": "exp_data",
+            "exp_version": "1.0",
+            "exp_session_id": "a",
+            "exp_data": {"b": {"value": 1}, "mc": {"value": {"x": True}}},
+            "additional_data": {"k": {"n": 1}},
+        },
+        {
+            "_id": 2,
+            "type": "exp_data",
+            "exp_version": "1.0",
+            "exp_data": {"a": {"value": 2}},
+            "additional_data": {},
+        },
+    ]
+
+    def test_order_fieldnames(self):
+        expected = DataManager.extract_ordered_fieldnames(
+            dict(d) for d in self.datasets
+        )
+
+        fieldnames = {}
+        for d in reversed(self.datasets):
+            fieldnames.update(DataManager.flatten(dict(d)))
+
+        assert FieldnameCatalog.order_fieldnames(fieldnames) == expected
+
+    def test_late_unlinked_field(self, app_context, alfred_db):
+        col = alfred_db["unlinked"]
+        dataset = {"exp_id": "x", "exp_version": "1.0", "type": "unlinked"}
+        _id = col.insert_one({**dataset, "exp_data": {"a": {"value": 1}}}).inserted_id
+
+        catalog = FieldnameCatalog.get("x", "1.0", "unlinked", col)
+        assert "a" in catalog.fieldnames and "b" not in catalog.fieldnames
+
+        # unlinked datasets are updated in place during a session
+        col.update_one({"_id": _id}, {"$set": {"exp_data.b": {"value": 2}}})
+        catalog = FieldnameCatalog.get("x", "1.0", "unlinked", col)
+        assert "b" in catalog.fieldnames
+        assert FieldnameCatalog.objects.count() == 1
+
+    def test_no_save_without_changes(self, app_context, alfred_db):
+        col = alfred_db["alfred"]
+        col.insert_one(
+            {"exp_id": "x", "exp_version": "1.0", "type": "exp_data", "exp_data": {}}
+        )
+        FieldnameCatalog.get("x", "1.0", "exp_data", col)
+        last_update = FieldnameCatalog.objects.get().last_update
+
+        FieldnameCatalog.get("x", "1.0", "exp_data", col)
+        assert FieldnameCatalog.objects.get().last_update == last_update
+
+
+class TestCodebook:
+    def dataset(self, save_time, label, dtype="exp_data"):
+        dataset = {
+            "exp_id": "x",
+            "exp_version": "1.0",
+            "type": dtype,
+            "exp_title": "Title",
+            "exp_author": "Author",
+            "alfred_version": "3.0.2",
+            "exp_data": {
+                "q": {"name": "q", "value": 1, "label_top": label},
+            },
+        }
+        if save_time is not None:
+            dataset["exp_save_time"] = save_time
+        return dataset
+
+    def test_label_change(self, app_context, alfred_db):
+        col, col_unlinked = alfred_db["alfred"], alfred_db["unlinked"]
+        col.insert_one(self.dataset(1000.0, "Old"))
+        codebook = Codebook.get("x", "1.0", col, col_unlinked)
+        assert codebook.entries["q"]["label_top"] == "Old"
+        assert codebook.label_changes == []
+
+        col.insert_one(self.dataset(2000.0, "New"))
+        codebook = Codebook.get("x", "1.0", col, col_unlinked)
+        assert codebook.entries["q"]["label_top"] == "New"
+        assert codebook.label_changes == [
+            {"name": "q", "label": "label_top", "old": "Old", "new": "New"}
+        ]
+
+        # reading the newest dataset again keeps the change
+        codebook = Codebook.get("x", "1.0", col, col_unlinked)
+        assert codebook.entries["q"]["label_top"] == "New"
+        assert len(codebook.label_changes) == 1
+        assert Codebook.objects.count() == 1
+
+    def test_late_unlinked_field(self, app_context, alfred_db):
+        col, col_unlinked = alfred_db["alfred"], alfred_db["unlinked"]
+        _id = col_unlinked.insert_one(self.dataset(None, "U", "unlinked")).inserted_id
+        codebook = Codebook.get("x", "1.0", col, col_unlinked)
+        assert "late" not in codebook.entries
+
+        late = {"name": "late", "value": 2, "label_top": "Late"}
+        col_unlinked.update_one({"_id": _id}, {"$set": {"exp_data.late": late}})
+        codebook = Codebook.get("x", "1.0", col, col_unlinked)
+        assert codebook.entries["late"]["label_top"] == "Late"
+
+
+class TestExperimentStatistics:
+    @staticmethod
+    def dataset(**kwargs):
+        now = time.time()
+        return {
+            "exp_id": "x",
+            "type": "exp_data",
+            "exp_version": "1.0",
+            "exp_start_time": now - 1000,
+            "exp_save_time": now - 900,
+            "exp_finished": False,
+            **kwargs,
+        }
+
+    def test_count(self, app_context, alfred_db):
+        col = alfred_db["alfred"]
+        now = time.time()
+        col.insert_many(
+            [
+                self.dataset(exp_start_time=20.0),
+                self.dataset(exp_start_time=10.0, exp_finished=True),
+                self.dataset(exp_version="1.1", exp_start_time=30.0),
+                self.dataset(
+                    exp_start_time=5.0, exp_finished=True, alfred_version="3.0.2"
+                ),
+            ]
+        )
+        col.insert_one(self.dataset(exp_finished=True, alfred_version="3.0.1"))
+        ExperimentStatistics.get("x", col)
+
+        # everything is read again within the watermark lag
+        col.update_many({}, {"$set": {"exp_save_time": now}})
+        summary = ExperimentStatistics.get("x", col).summary()
+        assert summary["total"] == 5
+        assert summary["fin"] == 3
+        assert summary["versions"] == {
+            "1.0": {"total": 4, "fin": 3},
+            "1.1": {"total": 1, "fin": 0},
+        }
+        assert summary["alfred_versions"] == ["3.0.1", "3.0.2"]
+        assert summary["activity"]["first"] == 5.0
+
+        rebuilt = ExperimentStatistics.get("x", col, rebuild=True).summary()
+        assert rebuilt == summary
+
+    def test_late_first_save(self, app_context, alfred_db):
+        col = alfred_db["alfred"]
+        ExperimentStatistics.get("x", col)
+
+        # a session is saved for the first time minutes after it started
+        now = time.time()
+        col.insert_one(self.dataset(exp_start_time=now - 300, exp_save_time=now))
+        stats = ExperimentStatistics.get("x", col)
+        assert stats.summary()["total"] == 1
+
+    def test_resaved_session(self, app_context, alfred_db):
+        col = alfred_db["alfred"]
+        now = time.time()
+        _id = col.insert_one(self.dataset()).inserted_id
+        stats = ExperimentStatistics.get("x", col)
+        assert (stats.total, stats.fin) == (1, 0)
+
+        # the session is finished long after the last update
+        update = {"exp_save_time": now - 100, "exp_finished": True}
+        col.update_one({"_id": _id}, {"$set": update})
+        stats = ExperimentStatistics.get("x", col)
+        assert (stats.total, stats.fin) == (1, 1)
+
+        # and saved again
+        col.update_one({"_id": _id}, {"$set": {"exp_save_time": now}})
+        stats = ExperimentStatistics.get("x", col)
+        assert (stats.total, stats.fin) == (1, 1)
+        assert stats.summary()["versions"] == {"1.0": {"total": 1, "fin": 1}}
+
+    def test_unchanged(self, app_context, alfred_db):
+        col = alfred_db["alfred"]
+        col.insert_one(self.dataset())
+        ExperimentStatistics.get("x", col)
+        last_update = ExperimentStatistics.objects.get(exp_id="x").last_update
+
+        ExperimentStatistics.get("x", col)
+        assert ExperimentStatistics.objects.get(exp_id="x").last_update == last_update
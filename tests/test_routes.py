@@ -0,0 +1,158 @@
+import pytest
+
+pytest.importorskip("alfred3")
+
+
+class TestDataTable:
+    def page(self, client, start, direction, length=2):
+        args = {
+            "start": start,
+            "length": length,
+            "order[0][column]": 0,
+            "order[0][dir]": direction,
+            "columns[0][name]": "exp_session_id",
+        }
+        data = client.post("/tester/exp/data/table", data=args).get_json()
+        return [row[0] for row in data["data"]]
+
+    @pytest.mark.parametrize("direction", ["asc", "desc"])
+    def test_keyset_pages_with_nulls(self, client, alfred_db, user, direction):
+        from mortimer.models import WebExperiment
+
+        exp_id = str(WebExperiment.objects.get(title="exp").id)
+        sessions = ["b", None, "a", None, "c", None, "d"]
+        for i, session_id in enumerate(sessions):
+            dataset = {"exp_id": exp_id, "type": "exp_data", "exp_save_time": i}
+            if session_id is not None:
+                dataset["exp_session_id"] = session_id
+            alfred_db["alfred"].insert_one(dataset)
+
+        rows = []
+        for start in range(0, len(sessions) + 1, 2):
+            rows += self.page(client, start, direction)
+
+        expected = ["", "", "", "a", "b", "c", "d"]
+        if direction == "desc":
+            expected.reverse()
+        assert rows == expected
+
+    def test_wide_table(self, client, alfred_db, user):
+        from mortimer.models import WebExperiment
+
+        exp_id = str(WebExperiment.objects.get(title="exp").id)
+        exp_data = {f"q{i}": {"value": i} for i in range(300)}
+        alfred_db["alfred"].insert_one(
+            {"exp_id": exp_id, "type": "exp_data", "exp_data": exp_data}
+        )
+
+        args = {"start": 0, "length": 10}
+        for i in range(300):
+            args.update(
+                {
+                    f"columns[{i}][data]": i,
+                    f"columns[{i}][name]": f"q{i}",
+                    f"columns[{i}][searchable]": "true",
+                    f"columns[{i}][orderable]": "false",
+                    f"columns[{i}][search][value]": "",
+                    f"columns[{i}][search][regex]": "false",
+                }
+            )
+        data = client.post("/tester/exp/data/table", data=args).get_json()
+        assert data["data"] == [list(range(300))]
+
+
+class TestUserExperiments:
+    def test_bounded_statistics_update(self, app, client, user, monkeypatch):
+        from mortimer.models import ExperimentStatistics, WebExperiment
+
+        with app.app_context():
+            for title in ["a", "b", "c"]:
+                WebExperiment(
+                    title=title, author=user.username, author_id=user.id, version="1"
+                ).save()
+        monkeypatch.setitem(app.config, "STATISTICS_UPDATES_PER_PAGE", 2)
+
+        assert client.get("/tester/experiments").status_code == 200
+        assert ExperimentStatistics.objects.count() == 2
+        response = client.get("/tester/experiments")
+        assert ExperimentStatistics.objects.count() == 4
+        assert response.data.count(b'title="Counted ') == 4
+
+
+class TestQueryReport:
+    def test_linked_for_admins(self, app, client, user):
+        url = "/tester/exp/query_report"
+        assert url.encode() in client.get("/tester/exp").data
+
+        with app.app_context():
+            user.role = "user"
+            user.save()
+        assert url.encode() not in client.get("/tester/exp").data
+        assert client.get(url).status_code == 403
+
+
+class TestUserCache:
+    def test_role_change_on_next_request(self, app, client, user):
+        from mortimer.models import User
+
+        url = b"/tester/exp/query_report"
+        with app.app_context():
+            user.role = "user"
+            user.save()
+        assert url not in client.get("/tester/exp").data
+
+        with app.app_context():
+            promoted = User.objects.get(id=user.id)
+            promoted.role = "admin"
+            promoted.save()
+        assert url in client.get("/tester/exp").data
+
+
+class TestParticipation:
+    @pytest.fixture
+    def client(self, app, database):
+        client = app.test_client()
+        for alias, exp_id, exp_version in [("a", "e1", "1"), ("a", "e2", "2")]:
+            data = {"alias": alias, "exp_id": exp_id, "exp_version": exp_version}
+            assert client.post("/participation", data=data).status_code == 201
+        return client
+
+    def test_register(self, client):
+        data = {"alias": "a", "exp_id": "e1", "exp_version": "1"}
+        assert client.post("/participation", data=data).status_code == 200
+        data["exp_version"] = "2"
+        assert client.post("/participation", data=data).status_code == 201
+
+        args = {"alias": "a", "exp_id": "e1", "exp_version": "2"}
+        assert client.get("/participation", query_string=args).data == b"true"
+        args["alias"] = "b"
+        assert client.get("/participation", query_string=args).data == b"false"
+
+    def test_batch(self, client):
+        body = {
+            "aliases": ["a", "b"],
+            "experiments": [{"exp_id": "e1"}, {"exp_id": "e2", "exp_version": "1"}],
+        }
+        response = client.post("/participation/batch", json=body)
+        results = response.get_json()["results"]
+        assert [r["participated"] for r in results] == [True, False, False, False]
+
+    @pytest.mark.parametrize(
+        "body",
+        [
+            None,
+            {"alias": "a"},
+            {"aliases": [1], "experiments": [{"exp_id": "e1"}]},
+            {"alias": "a", "experiments": ["e1"]},
+            {"alias": "a", "experiments": [{"exp_id": 1}]},
+            {"alias": "a", "experiments": [{"exp_id": "e1", "exp_version": 1}]},
+            {"alias": "a", "experiments": [{"exp_id": "e.1"}]},
+        ],
+    )
+    def test_batch_invalid(self, client, body):
+        assert client.post("/participation/batch", json=body).status_code == 400
+
+    def test_batch_size(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, "PARTICIPATION_BATCH_SIZE", 1)
+        body = {"aliases": ["a", "b"], "experiments": [{"exp_id": "e1"}]}
+        assert client.post("/participation/batch", json=body).status_code == 413
@@ -1,3 +1,5 @@
+import pytest
+
 import mortimer.utils as utils
 
 
@@ -11,3 +13,112 @@ class TestSocialMediaPreview:
         ua = "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)"
         check = utils.is_social_media_preview(ua)
         assert check
+
+
+class TestPluginDataQueries:
+    q1 = {"title": "A", "type": "a", "query": {"filter": {"x": 1}}}
+    q2 = {"title": "B", "type": "b", "query": {"filter": {"x": 2}}}
+
+    def test_find_plugin_data_queries(self):
+        mongomock = pytest.importorskip("mongomock")
+        col = mongomock.MongoClient()["alfred"]["col"]
+        col.insert_many(
+            [
+                {"exp_id": "e", "type": "exp_data", "exp_plugin_queries": [self.q2]},
+                {
+                    "exp_id": "e",
+                    "type": "exp_data",
+                    "exp_plugin_queries": [{}, self.q1, self.q2],
+                },
+                {"exp_id": "e", "type": "exp_data"},
+                {
+                    "exp_id": "other",
+                    "type": "exp_data",
+                    "exp_plugin_queries": [{"title": "C"}],
+                },
+            ]
+        )
+
+        queries = utils.find_plugin_data_queries(col, "e")
+        assert queries == [self.q2, self.q1]
+
+    def test_stamped_cache(self):
+        cache = utils.StampedCache(maxsize=2)
+        cache.set("a", "value", stamp=1)
+
+        assert cache.get("a", 1) == "value"
+        assert cache.get("a", 2) is None
+
+        cache.set("b", "b", stamp=1)
+        cache.set("c", "c", stamp=1)
+        assert cache.get("a", 1) is None
+
+    def test_stamped_cache_ttl(self):
+        cache = utils.StampedCache(ttl=-1)
+        cache.set("a", "value")
+        assert cache.get("a") is None
+
+
+class TestPaginatedFind:
+    def test_pages(self):
+        mongomock = pytest.importorskip("mongomock")
+        col = mongomock.MongoClient()["alfred"]["col"]
+        col.insert_many([{"n": i} for i in range(10)])
+
+        docs = []
+        for doc in utils.paginated_find(col, {"n": {"$gte": 2}}, page_size=3):
+            doc["_id"] = str(doc["_id"])  # callers may modify documents
+            docs.append(doc)
+
+        assert [d["n"] for d in docs] == list(range(2, 10))
+
+    def test_custom_sort(self):
+        mongomock = pytest.importorskip("mongomock")
+        col = mongomock.MongoClient()["alfred"]["col"]
+        col.insert_many([{"n": i} for i in range(5)])
+
+        docs = utils.paginated_find(col, page_size=2, sort=[("n", -1)])
+        assert [d["n"] for d in docs] == [4, 3, 2, 1, 0]
+
+
+class TestExplainQuery:
+    def test_summarize_explanation(self):
+        explanation = {
+            "queryPlanner": {
+                "winningPlan": {
+                    "stage": "SORT",
+                    "inputStage": {
+                        "stage": "FETCH",
+                        "inputStage": {"stage": "COLLSCAN"},
+                    },
+                },
+                "rejectedPlans": [
+                    {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}
+                ],
+            },
+            "executionStats": {"totalDocsExamined": 40, "totalKeysExamined": 0},
+        }
+        summary = utils.summarize_explanation(explanation)
+        assert summary["stages"] == ["SORT", "FETCH", "COLLSCAN"]
+        assert summary["collscan"]
+        assert summary["docs_examined"] == 40
+
+    def test_aggregation_explanation(self):
+        explanation = {
+            "stages": [
+                {
+                    "$cursor": {
+                        "queryPlanner": {
+                            "winningPlan": {
+                                "stage": "FETCH",
+                                "inputStage": {"stage": "IXSCAN"},
+                            }
+                        }
+                    }
+                },
+                {"$group": {}},
+            ]
+        }
+        summary = utils.summarize_explanation(explanation)
+        assert summary["stages"] == ["FETCH", "IXSCAN"]
+        assert not summary["collscan"]